@@ -0,0 +1,7 @@
+"""
+    benchmarks
+    ~~~~~~~~~~
+
+    Benchmarks of cracken's hot paths, run against synthetic password corpora
+    from `benchmarks.corpus`. Run the suite with `python -m benchmarks.suite`.
+"""
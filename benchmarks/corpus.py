@@ -0,0 +1,103 @@
+"""
+    benchmarks.corpus
+    ~~~~~~~~~~~~~~~~~
+
+    This module generates synthetic password corpora for the benchmarks, so
+    that runs are repeatable without shipping a real password leak.
+
+    Passwords are built from a set of templates, such as a word followed by
+    digits, whose frequencies, like those of the words, digit strings and
+    symbols filling them, follow a Zipf distribution. The size of the corpus,
+    the size of the vocabulary and the skew of the distributions are all
+    controllable, and the same seed always gives the same corpus.
+"""
+import bisect
+import random
+import string
+
+# Templates, in order of decreasing frequency. W is a lower-case word, C a
+# capitalized word, D a digit string and S a symbol.
+TEMPLATES = ["WD", "W", "CD", "WDS", "D", "WW", "CDS", "WSD", "DW", "CWD"]
+
+SYMBOLS = "!@#$.*_?-&"
+
+def zipf_sampler(items, skew, rng):
+    """Return a function which draws an item from `items`, the i'th item
+    with probability proportional to `1 / (i + 1) ** skew`"""
+    cumulative, total = [], 0.0
+    for i in range(len(items)):
+        total += 1.0 / (i + 1) ** skew
+        cumulative.append(total)
+    return lambda: items[
+        bisect.bisect_right(cumulative, rng.random() * total)
+    ]
+
+
+def vocabulary(size, rng, min_len=3, max_len=10):
+    """Return `size` distinct random lower-case words"""
+    words, seen = [], set()
+    while len(words) < size:
+        word = "".join(rng.choice(string.ascii_lowercase)
+            for _ in range(rng.randint(min_len, max_len)))
+        if word not in seen:
+            seen.add(word)
+            words.append(word)
+    return words
+
+
+def digit_strings(rng, count=500):
+    """Return `count` distinct digit strings, years and short runs first"""
+    strings = ["1", "12", "123", "1234", "007", "69", "11", "0"]
+    strings += [str(year) for year in range(1960, 2025)]
+    seen = set(strings)
+    while len(strings) < count:
+        s = str(rng.randint(0, 10 ** rng.randint(1, 6)))
+        if s not in seen:
+            seen.add(s)
+            strings.append(s)
+    return strings
+
+
+def passwords(count, vocab_size=5000, skew=1.1, seed=0):
+    """Yield `count` synthetic passwords.
+
+    `vocab_size` is the number of distinct words, and `skew` the exponent of
+    the Zipf distributions; higher skews concentrate the corpus on fewer
+    templates, words and digit strings.
+    """
+    rng = random.Random(seed)
+    template = zipf_sampler(TEMPLATES, skew, rng)
+    word = zipf_sampler(vocabulary(vocab_size, rng), skew, rng)
+    digits = zipf_sampler(digit_strings(rng), skew, rng)
+    symbol = zipf_sampler(SYMBOLS, skew, rng)
+    fill = {
+        "W": word,
+        "C": lambda: word().capitalize(),
+        "D": digits,
+        "S": symbol,
+    }
+    for _ in xrange(count):
+        yield "".join(fill[part]() for part in template())
+
+
+def write_corpus(fname, count, vocab_size=5000, skew=1.1, seed=0):
+    """Write `count` synthetic passwords to the file named `fname`, one per
+    line"""
+    with open(fname, "w") as f:
+        for password in passwords(count, vocab_size, skew, seed):
+            f.write(password + "\n")
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("output")
+    parser.add_argument("-n", "--count", type=int, default=100000,
+        help="number of passwords to generate")
+    parser.add_argument("--vocab", type=int, default=5000,
+        help="number of distinct words")
+    parser.add_argument("--skew", type=float, default=1.1,
+        help="exponent of the Zipf distributions")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    write_corpus(args.output, args.count, args.vocab, args.skew, args.seed)
@@ -0,0 +1,444 @@
+"""
+    benchmarks.suite
+    ~~~~~~~~~~~~~~~~
+
+    This module implements the benchmark suite. Each benchmark times one of
+    cracken's hot paths over a synthetic corpus and the profile classified
+    from it, and reports its rate in lines, preterminals, guesses, tasks or
+    round trips per second, along with the peak memory of the process which
+    ran it. The Bullpen benchmarks are run over each of its transports.
+
+    The parallel benchmarks, those of the Bullpen and the parallel classifier
+    and heap, run with each number of workers given with `--workers`, so that
+    their scaling can be measured, and also report their rate per core used:
+
+        python -m benchmarks.suite bullpen classify_parallel --workers 1,2,4
+
+    Every run of a benchmark is made in a freshly forked process, so that its
+    peak memory is its own and the Bullpen can be started anew, and the
+    fastest of `repeat` runs is kept. Results are saved as JSON, tagged with
+    the commit and machine they were measured on, and an earlier results file
+    can be given to compare against:
+
+        python -m benchmarks.suite -o after.json --compare before.json
+"""
+from __future__ import absolute_import
+
+from collections    import OrderedDict
+
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from cracken.classifier import profile_file
+from cracken.dedup      import BloomFilter
+from cracken.generator  import ParallelPreTerminalHeap, PreTerminalHeap
+from cracken.guessers   import ManglingGuesser, PreTerminalGuesser
+from cracken.hashing    import HashTarget
+
+from .                  import corpus, tasks
+
+BENCHMARKS = OrderedDict()
+
+def benchmark(unit, parallel=False):
+    """Register the decorated function as a benchmark measured in `unit`s.
+    The function is called with the Workspace to set the benchmark up, and
+    returns the function to be timed, which returns the number of units it
+    processed. A `parallel` benchmark runs `ws.workers` processes."""
+    def register(func):
+        BENCHMARKS[func.__name__] = (func, unit, parallel)
+        return func
+    return register
+
+
+class Workspace(object):
+    """The files shared by the benchmarks: a synthetic corpus of `lines`
+    passwords, and the base structures, grammar and glossary classified from
+    it. `scale` multiplies the amount of work done by the benchmarks which
+    don't read the corpus, and `workers` is the number of processes the
+    parallel benchmarks run."""
+    def __init__(self, lines=200000, vocab_size=5000, skew=1.1, seed=0,
+            scale=1.0, port=8123, dir=None, workers=2):
+        self.lines = lines
+        self.scale = scale
+        self.port = port
+        self.workers = workers
+        self.dir = tempfile.mkdtemp(prefix="cracken-bench-", dir=dir)
+        self.corpus = os.path.join(self.dir, "corpus.txt")
+        self.structs = os.path.join(self.dir, "base_structs.txt")
+        self.grammar = os.path.join(self.dir, "prob_grammar.txt")
+        self.glossary = os.path.join(self.dir, "glossary.txt")
+
+        corpus.write_corpus(self.corpus, lines, vocab_size, skew, seed)
+        profile_file(self.corpus, processes=1).write(
+            self.structs, self.grammar, self.glossary
+        )
+
+
+    def count(self, n):
+        return max(1, int(n * self.scale))
+
+
+    def preterminals(self, n):
+        """Return the `n` most likely preterminals, as strings"""
+        heap = PreTerminalHeap(self.structs, self.grammar)
+        return [str(pt) for pt in itertools.islice(heap, n)]
+
+
+    def guessers(self, ordered=False):
+        """Return a PreTerminalGuesser for each of the most likely
+        preterminals, with the glossary loaded"""
+        PreTerminalGuesser.load_glossary(self.glossary)
+        return [PreTerminalGuesser(pt, ordered)
+            for pt in self.preterminals(self.count(1000))]
+
+
+    def cleanup(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+def _guess(guessers, n):
+    """Yield blocks of guesses from `guessers` in turn, starting over once
+    they are exhausted, until at least `n` guesses have been made"""
+    made = 0
+    for guesser in itertools.cycle(guessers):
+        for block in guesser.blocks():
+            yield block
+            made += len(block)
+            if made >= n:
+                return
+
+
+@benchmark("lines")
+def classify(ws):
+    return lambda: profile_file(ws.corpus, processes=1).total
+
+
+@benchmark("lines", parallel=True)
+def classify_parallel(ws):
+    return lambda: profile_file(ws.corpus, ws.workers, 1<<20).total
+
+
+@benchmark("preterminals")
+def heap(ws):
+    def work():
+        pts = PreTerminalHeap(ws.structs, ws.grammar)
+        return sum(1 for _ in itertools.islice(pts, ws.count(100000)))
+    return work
+
+
+# The same preterminals as `heap`, with at most 1000 entries kept in memory,
+# to compare their peak memory
+@benchmark("preterminals")
+def heap_spill(ws):
+    def work():
+        pts = PreTerminalHeap(ws.structs, ws.grammar,
+            max_queue=ws.count(1000), spill_dir=ws.dir)
+        return sum(1 for _ in itertools.islice(pts, ws.count(100000)))
+    return work
+
+
+@benchmark("preterminals", parallel=True)
+def heap_parallel(ws):
+    def work():
+        pts = ParallelPreTerminalHeap(ws.structs, ws.grammar, ws.workers)
+        made = sum(1 for _ in itertools.islice(pts, ws.count(100000)))
+        pts.close()
+        return made
+    return work
+
+
+@benchmark("preterminals")
+def heap_glossary(ws):
+    def work():
+        pts = PreTerminalHeap(ws.structs, ws.grammar, glossary=ws.glossary)
+        return sum(1 for _ in itertools.islice(pts, ws.count(50000)))
+    return work
+
+
+@benchmark("guesses")
+def guesser(ws):
+    guessers = ws.guessers()
+    return lambda: sum(len(block)
+        for block in _guess(guessers, ws.count(2000000)))
+
+
+@benchmark("guesses")
+def guesser_ordered(ws):
+    guessers = ws.guessers(ordered=True)
+    return lambda: sum(len(block)
+        for block in _guess(guessers, ws.count(500000)))
+
+
+@benchmark("guesses")
+def mangle(ws):
+    ManglingGuesser.rules = list(tasks.LEET_RULES)
+    blocks = list(_guess(ws.guessers(), ws.count(200000)))
+    return lambda: sum(len(ManglingGuesser.mangle_block(block))
+        for block in blocks)
+
+
+@benchmark("guesses")
+def hashing(ws):
+    blocks = list(_guess(ws.guessers(), ws.count(1000000)))
+    target = HashTarget("sha256", "00" * 32, prefix="benchmark:")
+    return lambda: target.crack(blocks)["attempts"]
+
+
+@benchmark("guesses")
+def dedup(ws):
+    ManglingGuesser.rules = list(tasks.LEET_RULES)
+    blocks = [ManglingGuesser.mangle_block(block)
+        for block in _guess(ws.guessers(), ws.count(200000))]
+    seen = BloomFilter(sum(len(block) for block in blocks))
+
+    def work():
+        for block in blocks:
+            seen.filter_block(block)
+        return sum(len(block) for block in blocks)
+    return work
+
+
+def _bullpen(ws, target, args, transport="manager"):
+    """Return a function which runs `args` as tasks on a local Bullpen of
+    `ws.workers` workers, and returns the results"""
+    from cracken.bullpen import Bullpen
+    tasks.load(ws.glossary)
+    bp = Bullpen(None, target, host="127.0.0.1", port=ws.port,
+        processes=ws.workers, prefetch=4, result_batch=64,
+        transport=transport)
+    results = []
+    bp.on_result(results.append)
+    Bullpen.launch_workers()
+    while bp.running_workers < ws.workers:
+        time.sleep(0.01)
+
+    def work():
+        bp.enqueue_many(args)
+        bp.kill_workers()
+        bp.join()
+        return results
+    return work
+
+
+def _round_trips(ws, transport):
+    """Return a function which submits tasks to a local Bullpen of one worker
+    one at a time, each once the last has completed, and returns the number
+    of round trips made"""
+    from cracken.bullpen import Bullpen
+    bp = Bullpen(None, "benchmarks.tasks.echo", host="127.0.0.1",
+        port=ws.port, transport=transport)
+    Bullpen.launch_workers()
+    while bp.running_workers < 1:
+        time.sleep(0.01)
+
+    def work():
+        count = ws.count(2000)
+        for i in xrange(count):
+            bp.submit(i).result()
+        bp.kill_workers()
+        bp.join()
+        return count
+    return work
+
+
+@benchmark("tasks", parallel=True)
+def bullpen(ws):
+    work = _bullpen(ws, "benchmarks.tasks.echo",
+        [(i,) for i in xrange(ws.count(20000))])
+    return lambda: len(work())
+
+
+@benchmark("tasks", parallel=True)
+def bullpen_socket(ws):
+    work = _bullpen(ws, "benchmarks.tasks.echo",
+        [(i,) for i in xrange(ws.count(20000))], "socket")
+    return lambda: len(work())
+
+
+@benchmark("tasks", parallel=True)
+def bullpen_shm(ws):
+    work = _bullpen(ws, "benchmarks.tasks.echo",
+        [(i,) for i in xrange(ws.count(20000))], "shm")
+    return lambda: len(work())
+
+
+@benchmark("round trips")
+def latency(ws):
+    return _round_trips(ws, "manager")
+
+
+@benchmark("round trips")
+def latency_socket(ws):
+    return _round_trips(ws, "socket")
+
+
+@benchmark("round trips")
+def latency_shm(ws):
+    return _round_trips(ws, "shm")
+
+
+@benchmark("guesses", parallel=True)
+def end_to_end(ws):
+    work = _bullpen(ws, "benchmarks.tasks.crack",
+        [(pt,) for pt in ws.preterminals(ws.count(200))])
+    return lambda: sum(result["attempts"] for result in work())
+
+
+@benchmark("guesses", parallel=True)
+def end_to_end_socket(ws):
+    work = _bullpen(ws, "benchmarks.tasks.crack",
+        [(pt,) for pt in ws.preterminals(ws.count(200))], "socket")
+    return lambda: sum(result["attempts"] for result in work())
+
+
+def _run_once(setup, ws, conn):
+    work = setup(ws)
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    count = work()
+    seconds = time.time() - start
+    conn.send({
+        "count": count,
+        "seconds": seconds,
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "setup_rss_kb": start_rss,
+    })
+
+
+def run(name, ws, repeat=3):
+    """Run the benchmark `name` `repeat` times, each in a forked process, and
+    return the fastest run, with the largest peak memory of any run. The
+    rate of a parallel benchmark is also given per core used, that is per
+    worker, up to one per core."""
+    setup, unit, parallel = BENCHMARKS[name]
+    runs = []
+    for _ in range(repeat):
+        parent, child = multiprocessing.Pipe(False)
+        proc = multiprocessing.Process(target=_run_once,
+            args=(setup, ws, child))
+        proc.start()
+        runs.append(parent.recv())
+        proc.join()
+
+    best = min(runs, key=lambda r: r["seconds"])
+    best.update({
+        "unit": unit,
+        "rate": best["count"] / best["seconds"],
+        "peak_rss_kb": max(r["peak_rss_kb"] for r in runs),
+        "runs": [r["seconds"] for r in runs],
+    })
+    if parallel:
+        cores = min(ws.workers, multiprocessing.cpu_count())
+        best.update(workers=ws.workers, rate_per_core=best["rate"] / cores)
+    return best
+
+
+def machine():
+    """Describe the commit and machine the benchmarks are run on"""
+    try:
+        commit = subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], stderr=open(os.devnull, "w")
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": multiprocessing.cpu_count(),
+        "time": time.time(),
+    }
+
+
+def compare(results, baseline):
+    """Write a table of the rates in `results` against those in `baseline`"""
+    sys.stdout.write("\n{:18} {:>14} {:>14} {:>8}\n".format(
+        "benchmark", "baseline", "current", "change"))
+    for name, result in results.items():
+        old = baseline.get(name)
+        if old is None:
+            continue
+        sys.stdout.write("{:18} {:>14.0f} {:>14.0f} {:>+7.1f}%\n".format(
+            name, old["rate"], result["rate"],
+            100.0 * (result["rate"] / old["rate"] - 1)
+        ))
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmarks", nargs="*",
+        help="benchmarks to run, all of them by default: " +
+            ", ".join(BENCHMARKS))
+    parser.add_argument("-o", "--output", default="benchmark.json",
+        help="file to which the results are saved as JSON")
+    parser.add_argument("-c", "--compare", metavar="RESULTS",
+        help="results of an earlier run to compare against")
+    parser.add_argument("-n", "--lines", type=int, default=200000,
+        help="number of passwords in the synthetic corpus")
+    parser.add_argument("--vocab", type=int, default=5000,
+        help="number of distinct words in the corpus")
+    parser.add_argument("--skew", type=float, default=1.1,
+        help="exponent of the corpus' Zipf distributions")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--scale", type=float, default=1.0,
+        help="multiplies the work done by the other benchmarks")
+    parser.add_argument("-r", "--repeat", type=int, default=3)
+    parser.add_argument("-w", "--workers", default="2",
+        help="comma-separated numbers of workers with which to run each of "
+            "the parallel benchmarks, such as 1,2,4,8")
+    parser.add_argument("--port", type=int, default=8123,
+        help="port for the Bullpen benchmarks' Manager server, and the "
+            "port after it for their socket transport")
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark: {}".format(name))
+    try:
+        workers = [int(n) for n in args.workers.split(",")]
+    except ValueError:
+        parser.error("--workers takes numbers separated by commas")
+
+    params = dict((key, getattr(args, key))
+        for key in ("lines", "vocab", "skew", "seed", "scale", "repeat"))
+    params["workers"] = workers
+    ws = Workspace(args.lines, args.vocab, args.skew, args.seed, args.scale,
+        args.port)
+    results = OrderedDict()
+    try:
+        for name in args.benchmarks or BENCHMARKS:
+            # Parallel benchmarks are run with each number of workers, and
+            # named after it if there are several
+            counts = workers if BENCHMARKS[name][2] else [None]
+            for count in counts:
+                key = name
+                if count is not None:
+                    ws.workers = count
+                    if len(counts) > 1:
+                        key = "{}@{}".format(name, count)
+                results[key] = result = run(name, ws, args.repeat)
+                sys.stdout.write("{:18} {:>14.0f} {}/s {:>8.3f}s {:>8} KB"
+                    .format(key, result["rate"], result["unit"],
+                        result["seconds"], result["peak_rss_kb"]))
+                if "rate_per_core" in result:
+                    sys.stdout.write(" {:>12.0f}/core".format(
+                        result["rate_per_core"]))
+                sys.stdout.write("\n")
+    finally:
+        ws.cleanup()
+
+    with open(args.output, "w") as f:
+        json.dump({"machine": machine(), "params": params, "results": results},
+            f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f)["results"])
@@ -0,0 +1,38 @@
+"""
+    benchmarks.tasks
+    ~~~~~~~~~~~~~~~~
+
+    Worker functions for the Bullpen benchmarks. The benchmarks run their
+    workers locally, so the glossary and mangling rules set up by `load` in
+    the head are inherited by the forked workers.
+"""
+from cracken.guessers import ManglingGuesser, PreTerminalGuesser
+from cracken.hashing  import HashTarget
+
+# A target which is never found, so every guess is hashed
+target = HashTarget("sha256", "00" * 32, prefix="benchmark:")
+
+LEET_RULES = [
+    lambda s: s.replace("a", "4"),
+    lambda s: s.replace("e", "3"),
+    lambda s: s.replace("i", "1"),
+    lambda s: s.replace("o", "0"),
+    lambda s: s + "!",
+]
+
+def load(glossary):
+    """Load the glossary, and register the mangling rules"""
+    PreTerminalGuesser.load_glossary(glossary)
+    ManglingGuesser.rules = list(LEET_RULES)
+
+
+def echo(i):
+    return i
+
+
+def crack(preterminal):
+    """Guess every fill of `preterminal`, mangled, against the target"""
+    guesser = PreTerminalGuesser(preterminal)
+    return target.crack(
+        ManglingGuesser.mangle_block(block) for block in guesser.blocks()
+    )
@@ -3,55 +3,453 @@
     ~~~~~~~~~~~~~~~
 
     This module provides the Bullpen class, which starts and manages workers on
-    remote hosts to run commands, as well as the Bullpen's workers
+    remote hosts to run commands, as well as the Bullpen's workers.
+
+    Each host runs a single launcher, `run_workers`, which imports the worker
+    module once and then forks the worker processes, so that data loaded at
+    import time is shared between them copy-on-write. The launcher tells the
+    Bullpen how many workers it forked, so that the Bullpen knows how many to
+    wait for.
+
+    A Bullpen's results and status events are read from the Manager by a
+    dispatcher thread. They can be consumed by iterating over `results`, by
+    registering callbacks with `on_result` and `on_status`, or per task through
+    the Task handles returned by `submit`.
+
+    Worker functions may use `emit` to send results back while a task is still
+    running, and `post` and `on_notice` to broadcast notices to, and receive
+    them from, every worker of their Bullpen. Worker modules may use
+    `on_launch` to set up state for each Bullpen, shared by its workers on a
+    host, and `retried` to tell a task handed out again after its worker was
+    lost. Long running tasks should check
+    `cancelled` in their inner loops, and return early once the Bullpen has
+    cancelled the tasks queued before it. Workers report their counters from
+    `cracken.telemetry` to the head periodically.
+
+    Instead of launching its own workers, a Bullpen can post its job for the
+    long-lived worker daemons of `cracken.daemon` to pick up, and its workers
+    can reach it through the lighter transports of `cracken.transport` rather
+    than the Manager.
 """
-from multiprocessing.managers   import BaseManager
+from __future__ import absolute_import
+
+from multiprocessing.connection import Client, Listener
+from multiprocessing.managers   import BaseManager, listener_client
 from os                         import getenv, path
-from Queue                      import Queue
+from Queue                      import Empty, Queue
 from string                     import ascii_letters
 
+from .                          import telemetry
+from .transport                 import (RemoteObject, RpcClient,
+                                    ring_channels, serve, serve_forever)
+
+import collections
+import cPickle
+import itertools
+import multiprocessing
+import os
 import pydoc
 import random
 import shlex
 import socket
 import subprocess
-import sys
 import tempfile
+import threading
 import time
+import traceback
+
+def _set_nodelay(conn):
+    """Disable Nagle's algorithm on a Manager connection. Messages over 16KB
+    are written in two parts, and the second part would otherwise wait for
+    the peer's delayed ACK, adding 40ms to every large batch."""
+    sock = socket.fromfd(conn.fileno(), socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.close()
+
+
+class _NoDelayListener(Listener):
+    def accept(self):
+        conn = Listener.accept(self)
+        _set_nodelay(conn)
+        return conn
+
+
+def _nodelay_client(address, family=None, authkey=None):
+    conn = Client(address, family, authkey)
+    _set_nodelay(conn)
+    return conn
+
+
+listener_client["bullpen"] = (_NoDelayListener, _nodelay_client)
+
 
 class BullpenManager(BaseManager):
-    pass
+    def __init__(self, address=None, authkey=None):
+        BaseManager.__init__(self, address, authkey, serializer="bullpen")
+
+
+class BatchQueue(Queue):
+    """A Queue which can put and get many items in one call, so that a batch
+    of tasks or results costs a single round trip through the Manager.
+    TERM control messages end a batch, so that each worker receives its own.
+
+    A queue with a `maxsize` is bounded. Once it fills, `put_many` blocks
+    until it has drained to `low_water` items, by default half of `maxsize`,
+    so that a producer is woken to refill it in batches rather than once per
+    item.
+
+    If `lease` is given, the tasks handed to a worker by `get_many` are
+    leased to it for that many seconds, and the worker renews its leases
+    while it is alive. Once a worker's leases expire its tasks are queued
+    again, ahead of the others, until they are acknowledged with `ack`. TERM
+    is held back from a worker while other workers hold leases, so that the
+    tasks of a worker lost at the end of a run still have a worker to run
+    them.
+
+    Once `close` is called, because no worker is left to run them, tasks are
+    no longer put, and producers waiting for room are woken.
+    """
+    def __init__(self, maxsize=0, low_water=None, lease=None):
+        Queue.__init__(self, maxsize)
+        self.low_water = maxsize // 2 if low_water is None else low_water
+        self.lease = lease
+        self._epoch = 0
+        self._leased = {}
+        self._deadlines = {}
+        self._lost = set()
+        self._closed = False
+
+
+    def put_many(self, items):
+        """Put each of `items` on the queue, blocking while it is full, and
+        return the number put. Tasks from a cancelled epoch, or put once the
+        queue is closed, are dropped."""
+        put = 0
+        with self.not_full:
+            for item in items:
+                if self._dropped(item):
+                    continue
+                if 0 < self.maxsize <= self._qsize():
+                    while self._qsize() > self.low_water and not self._closed:
+                        self.not_full.wait()
+                    # The epoch may have been cancelled while waiting
+                    if self._dropped(item):
+                        continue
+                self._put(item)
+                self.unfinished_tasks += 1
+                self.not_empty.notify()
+                put += 1
+        return put
+
+
+    def _dropped(self, item):
+        """Return True if `item` is a task which must not be queued. The
+        mutex must be held."""
+        return item[0] == "TASK" and (item[3] < self._epoch or self._closed)
+
+
+    def close(self):
+        """Drop the tasks put from now on, and wake the producers waiting for
+        room"""
+        with self.mutex:
+            self._closed = True
+            self.not_full.notify_all()
+
+
+    def get_many(self, count, timeout=None, worker=None):
+        """Remove and return a list of up to `count` items, waiting up to
+        `timeout` seconds for the first item. Returns an empty list if no item
+        arrived in time. The tasks are leased to `worker`, if given."""
+        items = []
+        with self.not_empty:
+            self._requeue_expired()
+            if timeout is not None:
+                deadline = time.time() + timeout
+            while not self._qsize() or self._holding_term(worker):
+                # Leases expire without waking anyone, so a worker held back
+                # from TERM looks for expired leases three times per period
+                wait = self.lease / 3.0 if self._qsize() else None
+                if timeout is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return items
+                    wait = min(wait or remaining, remaining)
+                self.not_empty.wait(wait)
+                self._requeue_expired()
+
+            while self._qsize() and len(items) < count:
+                item = self._get()
+                if items and item[0] == "TERM":
+                    self.queue.appendleft(item)
+                    break
+                items.append(item)
+                if item[0] == "TERM":
+                    break
+
+            if items:
+                self.not_full.notify_all()
+            if worker is not None and self.lease:
+                self._deadlines[worker] = time.time() + self.lease
+                for item in items:
+                    if item[0] == "TASK":
+                        self._leased[item[4]] = (worker, item)
+        return items
+
+
+    def renew(self, worker):
+        """Extend the leases held by `worker`"""
+        with self.mutex:
+            self._deadlines[worker] = time.time() + self.lease
+            self._lost.discard(worker)
+            self._requeue_expired()
+
+
+    def retire(self, worker):
+        """Forget `worker`, which is exiting with no tasks leased"""
+        with self.mutex:
+            self._deadlines.pop(worker, None)
+
+
+    def ack(self, task_ids):
+        """Release the leases on the completed tasks `task_ids`"""
+        with self.mutex:
+            for task_id in task_ids:
+                self._leased.pop(task_id, None)
+            if self._qsize() and self.queue[0][0] == "TERM":
+                self.not_empty.notify_all()
+
+
+    def _holding_term(self, worker):
+        """Return True if TERM is next, but workers other than `worker` still
+        hold leases. The mutex must be held."""
+        if not self.lease or self.queue[0][0] != "TERM":
+            return False
+        return any(holder != worker for holder, _ in self._leased.values())
+
+
+    def lost(self):
+        """Return the number of workers whose leases have expired"""
+        with self.mutex:
+            self._requeue_expired()
+            return len(self._lost)
+
+
+    def _requeue_expired(self):
+        """Queue the tasks of every worker whose leases have expired again,
+        in their original order. The mutex must be held."""
+        now = time.time()
+        expired = set(worker for worker, deadline in self._deadlines.items()
+            if deadline < now)
+        if not expired:
+            return
+
+        requeued = sorted(
+            (task_id, item) for task_id, (worker, item) in self._leased.items()
+            if worker in expired
+        )
+        for task_id, item in reversed(requeued):
+            del self._leased[task_id]
+            if item[3] >= self._epoch:
+                # Marked as retried, since the lost worker may have run part
+                # of it
+                self.queue.appendleft(item[:5] + (True,))
+                self.not_empty.notify()
+        for worker in expired:
+            del self._deadlines[worker]
+        self._lost.update(expired)
+
+
+    def discard_tasks(self, epoch):
+        """Remove the queued tasks stamped with an epoch before `epoch`,
+        keeping any control messages, and return the number removed. Tasks
+        from before `epoch` which are put afterwards are dropped."""
+        with self.mutex:
+            self._epoch = max(self._epoch, epoch)
+            kept = [item for item in self.queue
+                if item[0] != "TASK" or item[3] >= epoch]
+            discarded = len(self.queue) - len(kept)
+            self.queue.clear()
+            self.queue.extend(kept)
+            self.unfinished_tasks -= discarded
+            self.not_full.notify_all()
+        return discarded
+
+
+class NoticeBoard(object):
+    """An append-only log of notices broadcast to a Bullpen's workers, held in
+    the Manager server. Workers block in `since` until there is something new
+    to read, rather than polling."""
+    def __init__(self):
+        self._notices = []
+        self._cond = threading.Condition()
+
+
+    def post(self, notice):
+        with self._cond:
+            self._notices.append(notice)
+            self._cond.notify_all()
+
+
+    def since(self, seen, timeout=0):
+        """Return the notices after the first `seen`, waiting up to `timeout`
+        seconds for one to be posted if there are none, or indefinitely if
+        `timeout` is None"""
+        with self._cond:
+            while len(self._notices) <= seen and timeout is None:
+                self._cond.wait()
+            if len(self._notices) <= seen and timeout:
+                self._cond.wait(timeout)
+            return self._notices[seen:]
+
+
+class Task(object):
+    """A handle on a task enqueued with `Bullpen.submit`, which is completed
+    with the worker function's return value once a worker has run it"""
+    _lock = threading.Lock()
+
+    def __init__(self, task_id):
+        self.task_id = task_id
+        self._event = threading.Event()
+        self._value = None
+        self._cancelled = False
+        self._callbacks = []
+
+
+    def done(self):
+        return self._event.is_set()
+
+
+    def cancelled(self):
+        return self._cancelled
+
+
+    def result(self, timeout=None):
+        """Return the task's result, waiting up to `timeout` seconds for it,
+        or indefinitely if `timeout` is None"""
+        if not self._event.wait(timeout):
+            raise RuntimeError("Task not completed.")
+        if self._cancelled:
+            raise RuntimeError("Task cancelled.")
+        return self._value
+
+
+    def add_done_callback(self, callback):
+        """Call `callback` with this task once it completes, or immediately if
+        it already has. Callbacks run on the Bullpen's dispatcher thread."""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+
+    def _complete(self, value=None, cancelled=False):
+        with self._lock:
+            self._value, self._cancelled = value, cancelled
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
 
 class Bullpen(object):
     """The Bullpen starts and manages workers using the multiprocessing 
-    library's manager class as the transport layer"""
+    library's manager class as the transport layer.
+
+    `processes` worker processes are started on each host, or one per core if
+    it is "auto". If `hosts` is None, the workers are started on this host
+    with multiprocessing rather than over ssh.
+
+    Each worker fetches up to `prefetch` tasks from the Manager at a time and
+    holds them locally, and sends its results back in batches of up to
+    `result_batch`. Results are always sent before a worker waits for more
+    tasks.
+
+    If `max_queued` is given, at most that many tasks are held in the Manager
+    at once, and `enqueue_many` blocks while the queue is full, pulling tasks
+    from its iterable only as the workers make room for them.
+
+    Tasks are stamped with the Bullpen's epoch, which `cancel` advances. If
+    `stop_on` is given, it is called with each result, and the Bullpen is
+    cancelled as soon as it returns True.
+
+    If `lease` is given, a task handed to a worker is queued again if the
+    worker stops renewing its lease for that many seconds, for instance
+    because its host died. Tasks are numbered, and the Bullpen keeps those
+    which have not been completed, so that `checkpoint` can save them to be
+    enqueued again by `restore` in a later session.
+
+    Status events are dictionaries with an "event" key: "launched" events
+    name the "host" and give the number of "workers" its launcher forked,
+    "failed" events name the "host" and give the "error" which kept its
+    launcher from forking any, "started" and "terminated" events name the
+    "worker", and "lost" events give the number of "workers" whose leases
+    have expired. The Bullpen waits for a launcher on each of `hosts`, and
+    then for every worker they launched to terminate or be lost.
+
+    Every `metrics_interval` seconds, each worker reports its telemetry
+    counters from a background thread, even in the middle of a task, and
+    `metrics` returns a snapshot of them, together with the depth of the task
+    queue.
+
+    If `daemons` is True, no workers are launched. The job is posted instead,
+    and run by every worker daemon connected to the Manager. The daemons keep
+    the target module loaded between jobs until it, or one of the files named
+    in `resources`, changes. Daemons must share the Manager's `authkey`, which
+    is read from the BULLPEN_AUTHKEY environment variable if it is not given,
+    and otherwise generated at random. Only the first Bullpen's `authkey` and
+    address are used. A daemon is expected on each of `hosts`, or a single
+    daemon if `hosts` is None.
+
+    `transport` chooses how the workers reach the Bullpen's queues. With
+    "manager", they use the Manager's proxies. With "socket", they call the
+    queues held by the head itself, over sockets to the port after the
+    Manager's, and with "shm", which only works without hosts, over rings in
+    shared memory."""
     
     # Instantiated when an instance is instantiated
     _authkey = None
+    _address = None
     _server  = None
+    _launcher = None
+    _jobs_inst = None
+    _rpc_objects = {}
     _started = False
     _rand_str_history = []
     _instances = []
     
     def __init__(self, hosts, target, host='0.0.0.0', port=8000, cwd=None, 
-            user=None, id_file=None, venv=None):
+            user=None, id_file=None, venv=None, processes=1, prefetch=1,
+            result_batch=1, stop_on=None, max_queued=None, lease=None,
+            metrics_interval=10, authkey=None, daemons=False, resources=(),
+            transport="manager"):
         
         # Prevent instantiation after starting the server and instantiate the 
         # server with the first instance
         if (self._started):
             raise RuntimeError("Server started, can't make new Bullpens.")
+        if transport not in ("manager", "socket", "shm"):
+            raise ValueError("Unknown transport: {}".format(transport))
+        if transport == "shm" and (hosts is not None or daemons):
+            raise ValueError("The shm transport only works without hosts.")
         if (self._authkey == None):
-            self._instantiate_server(host, port)
+            self._instantiate_server(host, port, authkey)
 
         # Generate a unique identifier for this instance's, queues create the
         # queues, and register them with the BullpenManager
         self.queue_id         = self._gen_unique_random_string(8)
-        self._task_queue_inst = Queue()
-        self._res_queue_inst  = Queue()
+        self._task_queue_inst = BatchQueue(max_queued or 0, lease=lease)
+        self._res_queue_inst  = BatchQueue()
+        self._board_inst      = NoticeBoard()
         BullpenManager.register("get_t{}".format(self.queue_id), 
             callable=lambda:self._task_queue_inst)
         BullpenManager.register("get_r{}".format(self.queue_id),
             callable=lambda:self._res_queue_inst)
+        BullpenManager.register("get_b{}".format(self.queue_id),
+            callable=lambda:self._board_inst)
+        self._rpc_objects["t" + self.queue_id] = self._task_queue_inst
+        self._rpc_objects["r" + self.queue_id] = self._res_queue_inst
+        self._rpc_objects["b" + self.queue_id] = self._board_inst
 
         # Write the ssh command
         self.ssh_cmd = "/usr/bin/ssh -oStrictHostKeyChecking=no "
@@ -63,7 +461,42 @@ class Bullpen(object):
 
         # Write the worker script to be executed on the remote hosts
         self.hosts = hosts
+        self.daemons = daemons
+        self.transport = transport
         self.running_workers = 0
+        self.expected_workers = 0
+        self.epoch = 0
+        self.stop_on = stop_on
+        self.lost_workers = 0
+        self._launching = len(hosts) if hosts else 1
+        self._terminated = 0
+        self.telemetry = telemetry.Telemetry()
+        self._lease = lease
+        self._results = collections.deque()
+        self._lock = threading.Lock()
+        self._next_id = 0
+        self._pending = {}
+        self._tasks = {}
+        self._returns = {}
+        self._inbox = Queue()
+        self._status = threading.Condition()
+        self._finished = False
+        self._result_callbacks = []
+        self._status_callbacks = []
+        self._launch_args = (target, self.queue_id, processes, prefetch,
+            result_batch, lease, metrics_interval)
+        self._job = {
+            "queue_id": self.queue_id,
+            "target": target,
+            "cwd": path.abspath(cwd or "."),
+            "processes": processes,
+            "prefetch": prefetch,
+            "result_batch": result_batch,
+            "lease": lease,
+            "metrics_interval": metrics_interval,
+            "resources": list(resources),
+            "transport": transport,
+        }
         self.script_cmd = ""
         if cwd:
             self.script_cmd += "cd {};\n".format(cwd)
@@ -76,10 +509,11 @@ class Bullpen(object):
             )
         self.script_cmd += "export BULLPEN_AUTHKEY={}\n".format(self._authkey)
         self.script_cmd += ("nohup python -c \"" 
-            + "from cracken.bullpen import run_worker; "
-            + "run_worker('{}','{}','{}','{}');\" &\n"
-            + "exit\n"
-        ).format(target, socket.getfqdn(), port, self.queue_id)
+            + "from cracken.bullpen import run_workers; "
+            + "run_workers('{}','{}','{}','{}',{!r},{},{},{!r},{!r},None,{!r});"
+            + "\" &\nexit\n"
+        ).format(target, socket.getfqdn(), port, self.queue_id, processes,
+            prefetch, result_batch, lease, metrics_interval, transport)
        
         # Add this instance to the list of instances for launch_workers
         self._instances.append(self)
@@ -87,10 +521,49 @@ class Bullpen(object):
 
     def _start(self):
         """Start the Bullpen's workers via ssh and a shell script piped through
-        a temporary file. Also grab the Bullpen's task and result queues from 
-        the Manager server."""
-        self._task_queue = getattr(self._server, "get_t{}".format(self.queue_id))()
-        self._res_queue  = getattr(self._server, "get_r{}".format(self.queue_id))()
+        a temporary file, locally if there are no hosts, or post the job for
+        the worker daemons. Also grab the Bullpen's task and result queues
+        from the Manager server, or use them directly if the workers reach
+        them through another transport."""
+        if self.transport == "manager":
+            self._task_queue = getattr(self._server, "get_t{}".format(self.queue_id))()
+            self._res_queue  = getattr(self._server, "get_r{}".format(self.queue_id))()
+            self._board      = getattr(self._server, "get_b{}".format(self.queue_id))()
+        else:
+            self._task_queue = self._task_queue_inst
+            self._res_queue  = self._res_queue_inst
+            self._board      = self._board_inst
+
+        dispatcher = threading.Thread(target=self._dispatch)
+        dispatcher.daemon = True
+        dispatcher.start()
+        if self._lease:
+            watcher = threading.Thread(target=self._watch_leases)
+            watcher.daemon = True
+            watcher.start()
+
+        if self.daemons:
+            self._server.get_jobs().post(self._job)
+            return
+
+        if self.hosts is None:
+            (modpath, queue_id, processes, prefetch, result_batch, lease,
+                metrics_interval) = self._launch_args
+            host, port = self._address
+            if host in ("", "0.0.0.0"):
+                host = "127.0.0.1"
+            if processes == "auto":
+                processes = multiprocessing.cpu_count()
+            self._launcher = multiprocessing.Process(target=run_workers,
+                args=(modpath, host, port, queue_id, processes, prefetch,
+                    result_batch, lease, metrics_interval, self._authkey,
+                    self.transport, self._ring_channels(processes), False)
+            )
+            self._launcher.daemon = True
+            self._launcher.start()
+            self._handle_status({"event": "launched",
+                "host": socket.getfqdn(), "workers": processes})
+            return
 
         for host in self.hosts:
             with tempfile.TemporaryFile() as f:
@@ -102,14 +575,38 @@ class Bullpen(object):
                 )
 
 
+    def _ring_channels(self, processes):
+        """For the shm transport, make the rings through which each worker's
+        threads reach the queues, and serve the head's ends of them. Returns
+        the workers' ends, or None for the other transports."""
+        if self.transport != "shm":
+            return None
+        channels = []
+        for i in range(processes):
+            # The worker's main thread, notice board watcher and heartbeat
+            ends = [ring_channels() for j in range(3)]
+            for head_end, _ in ends:
+                server = threading.Thread(target=serve,
+                    args=(head_end, self._rpc_objects))
+                server.daemon = True
+                server.start()
+            channels.append([worker_end for _, worker_end in ends])
+        return channels
+
+
     @classmethod
-    def _instantiate_server(cls, host, port):
+    def _instantiate_server(cls, host, port, authkey=None):
         """Do the basic setup for the BullpenManager server, called when 
-        initializing the first Bullpen."""
+        initializing the first Bullpen. Also sets up the board on which jobs
+        are posted for the worker daemons."""
         if (cls._authkey != None):
             raise RuntimeError("Server can only be instantiated once.")
-        cls._authkey = cls._gen_unique_random_string(64)
+        cls._authkey = (authkey or getenv("BULLPEN_AUTHKEY")
+            or cls._gen_unique_random_string(64))
+        cls._address = (host, port)
         cls._server  = BullpenManager(address=(host,port), authkey=cls._authkey) 
+        cls._jobs_inst = NoticeBoard()
+        BullpenManager.register("get_jobs", callable=lambda:cls._jobs_inst)
 
 
     @classmethod
@@ -129,6 +626,16 @@ class Bullpen(object):
         if cls._started:
             raise RuntimeError("Server already started.")
         cls._server.start()
+        if any(inst.transport == "socket" for inst in cls._instances):
+            host, port = cls._address
+            # The default backlog of one would hold up workers connecting
+            # together until the kernel retried them
+            listener = _NoDelayListener((host, port + 1), backlog=128,
+                authkey=cls._authkey)
+            server = threading.Thread(target=serve_forever,
+                args=(listener, cls._rpc_objects))
+            server.daemon = True
+            server.start()
         for inst in cls._instances:
             inst._start()
         cls._started = True
@@ -137,70 +644,563 @@ class Bullpen(object):
     def enqueue(self, *args, **kwargs):
         """Pass the arguments and keyword arguments as a task, all arguments 
         must be pickle-able."""
-        self._task_queue.put(("TASK", args, kwargs))
+        with self._lock:
+            task = self._new_task(args, kwargs, self.epoch)
+        self._task_queue.put(task)
+
+
+    def submit(self, *args, **kwargs):
+        """Enqueue a task like `enqueue`, and return a Task which completes
+        with the worker function's return value"""
+        with self._lock:
+            task = self._new_task(args, kwargs, self.epoch)
+            handle = self._tasks[task[4]] = Task(task[4])
+        self._task_queue.put(task)
+        return handle
+
+
+    def _new_task(self, args, kwargs, epoch):
+        """Number a task and keep it until it is completed. The lock must be
+        held."""
+        task_id, self._next_id = self._next_id, self._next_id + 1
+        self._pending[task_id] = (args, kwargs)
+        return ("TASK", args, kwargs, epoch, task_id)
+
+
+    def enqueue_many(self, tasks, batch_size=1000):
+        """Enqueue each tuple of positional arguments in `tasks` as a task,
+        sending them to the Manager in batches of up to `batch_size`. `tasks`
+        is consumed lazily, one batch at a time, and the call blocks while a
+        bounded queue is full. Stops early if the Bullpen is cancelled, or once
+        no worker is left, and returns the number of tasks enqueued. Tasks
+        taken from `tasks` but not enqueued because the workers are gone are
+        still saved by `checkpoint`."""
+        tasks, count, epoch = iter(tasks), 0, self.epoch
+        while epoch == self.epoch and not self._finished:
+            with self._lock:
+                batch = [self._new_task(tuple(args), {}, epoch)
+                    for args in itertools.islice(tasks, batch_size)]
+            if not batch:
+                break
+            count += self._task_queue.put_many(batch)
+        return count
+
+
+    def queued(self):
+        """Return the number of messages waiting in the task queue"""
+        return self._task_queue.qsize()
+
+
+    def checkpoint(self, fname, state=None):
+        """Save the tasks which have not been completed to `fname`, along
+        with `state()`, which should describe how far the source of the tasks
+        has got. Tasks are taken from `enqueue_many`'s iterable under the same
+        lock, so the two agree. The file is replaced atomically."""
+        with self._lock:
+            snapshot = {
+                "state": state() if state else None,
+                "pending": [self._pending[i] for i in sorted(self._pending)],
+            }
+        with open(fname + ".tmp", "wb") as f:
+            cPickle.dump(snapshot, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(fname + ".tmp", fname)
+
+
+    def restore(self, fname):
+        """Enqueue the tasks saved to `fname` by `checkpoint`, and return the
+        saved state"""
+        with open(fname, "rb") as f:
+            snapshot = cPickle.load(f)
+        with self._lock:
+            batch = [self._new_task(args, kwargs, self.epoch)
+                for args, kwargs in snapshot["pending"]]
+        self._task_queue.put_many(batch)
+        return snapshot["state"]
+
+
+    def pending(self):
+        """Return the number of tasks enqueued but not yet completed"""
+        return len(self._pending)
+
+
+    def on_result(self, callback):
+        """Pass each result to `callback` on the dispatcher thread, instead of
+        holding it for `results` and `get_results`"""
+        self._result_callbacks.append(callback)
+
+
+    def on_status(self, callback):
+        """Call `callback` with each status event on the dispatcher thread"""
+        self._status_callbacks.append(callback)
+
+
+    def _dispatch(self):
+        """Read the messages sent by the workers until the connection to the
+        Manager is lost, completing tasks and passing on results and status
+        events"""
+        while True:
+            try:
+                messages = self._res_queue.get_many(1000)
+            except (EOFError, IOError):
+                return
+
+            results = []
+            for message in messages:
+                if message[0] == "RESULT":
+                    results.append(message[1])
+                    if len(message) > 2 and message[2] in self._tasks:
+                        self._returns[message[2]] = message[1]
+                elif message[0] == "DONE":
+                    self._handle_done(message[1])
+                elif message[0] == "STATUS":
+                    self._handle_results(results)
+                    results = []
+                    self._handle_status(message[1])
+                elif message[0] == "METRICS":
+                    self.telemetry.update(message[1])
+            self._handle_results(results)
+
+
+    def _handle_results(self, results):
+        """Pass `results` on, and cancel the Bullpen if one of them meets the
+        stop condition. Results are handled before any status event which
+        follows them, so that none arrive after the last worker terminates."""
+        if self.stop_on and any(self.stop_on(res) for res in results):
+            self.cancel()
+        for res in results:
+            if self._result_callbacks:
+                for callback in self._result_callbacks:
+                    callback(res)
+            else:
+                self._inbox.put(res)
+
+
+    def _watch_leases(self):
+        """Report a "lost" event whenever the number of workers whose leases
+        have expired changes"""
+        while True:
+            time.sleep(self._lease / 3.0)
+            try:
+                lost = self._task_queue.lost()
+            except (EOFError, IOError):
+                return
+            if lost != self.lost_workers:
+                self._handle_status({"event": "lost", "workers": lost})
+
+
+    def _handle_done(self, task_ids):
+        """Forget the completed tasks `task_ids`, and complete their handles.
+        Handles are completed once the lock is released, so that their
+        callbacks may submit more tasks."""
+        completed = []
+        with self._lock:
+            for task_id in task_ids:
+                self._pending.pop(task_id, None)
+                task = self._tasks.pop(task_id, None)
+                if task:
+                    completed.append((task, self._returns.pop(task_id, None)))
+        for task, value in completed:
+            task._complete(value)
+        if self._lease:
+            self._task_queue.ack(task_ids)
+
+
+    def _handle_status(self, event):
+        """Update the worker counts, pass `event` to the status callbacks, and
+        wake `join` once every launcher has reported, and every worker they
+        launched has terminated or been lost. The task queue is closed then,
+        as no worker is left to run its tasks."""
+        with self._status:
+            if event["event"] == "launched":
+                self._launching -= 1
+                self.expected_workers += event["workers"]
+            elif event["event"] == "failed":
+                self._launching -= 1
+            elif event["event"] == "started":
+                self.running_workers += 1
+            elif event["event"] == "terminated":
+                self.running_workers -= 1
+                self._terminated += 1
+            elif event["event"] == "lost":
+                self.lost_workers = event["workers"]
+
+            finishing = (not self._finished and self._launching <= 0 and
+                self.expected_workers - self._terminated <= self.lost_workers)
+            if finishing:
+                self._finished = True
+                self._inbox.put(StopIteration)
+            self._status.notify_all()
+
+        for callback in self._status_callbacks:
+            callback(event)
+        if finishing:
+            try:
+                self._task_queue.close()
+            except (EOFError, IOError):
+                pass
+
+
+    def metrics(self):
+        """Return a snapshot of the workers' telemetry, along with the number
+        of tasks queued and the worker counts"""
+        return self.telemetry.snapshot(
+            queued=self.queued(),
+            running_workers=self.running_workers,
+            lost_workers=self.lost_workers,
+        )
+
+
+    def _next_result(self):
+        """Return the next result held for `results`, or StopIteration once
+        every worker has terminated. Waits with a timeout, so that the wait
+        can be interrupted."""
+        while True:
+            try:
+                res = self._inbox.get(True, 60)
+            except Empty:
+                continue
+            if res is StopIteration:
+                self._inbox.put(res)
+            return res
+
+
+    def results(self):
+        """Yield each result as it arrives, until every worker has
+        terminated"""
+        while True:
+            res = self._next_result()
+            if res is StopIteration:
+                return
+            yield res
 
 
     def get_result(self):
-        """Return a result from the result queue, prints any status messages sent 
-        by workers, and blocks until a result is available"""
-        mtype, res = self._res_queue.get()
-        while mtype != "RESULT":
-            if mtype == "STATUS":
-                if "started" in res:
-                    self.running_workers += 1
-                if "TERM" in res:
-                    self.running_workers -= 1
-
-                sys.stdout.write("{}\n".format(res))
-            mtype, res = self._res_queue.get()
-        
-        return res
-    
+        """Return a result, blocking until one is available. Returns None once
+        every worker has terminated."""
+        if not self._results:
+            self._results.extend(self.get_results())
+        if not self._results:
+            return None
+        return self._results.popleft()
+
+
+    def get_results(self, max_results=1000):
+        """Return a list of up to `max_results` results, blocking until at
+        least one is available. Returns an empty list once every worker has
+        terminated."""
+        results = []
+        res = self._next_result()
+        while res is not StopIteration:
+            results.append(res)
+            if len(results) >= max_results:
+                break
+            try:
+                res = self._inbox.get_nowait()
+            except Empty:
+                break
+            if res is StopIteration:
+                self._inbox.put(res)
+        return results
+
+
+    def broadcast(self, notice):
+        """Post `notice` to every worker, where it is passed to the handlers
+        registered with `on_notice`. Notices must be pickle-able."""
+        self._board.post(notice)
+
+
+    def cancel(self):
+        """Cancel every task queued so far. Queued tasks are discarded, and
+        running tasks see `cancelled` return True. Tasks enqueued afterwards
+        run as usual. Returns the number of queued tasks discarded."""
+        with self._lock:
+            self.epoch += 1
+            self._pending.clear()
+            tasks, self._tasks = self._tasks, {}
+            self._returns.clear()
+        for task in tasks.values():
+            task._complete(cancelled=True)
+        self._board.post(("CANCEL", self.epoch))
+        return self._task_queue.discard_tasks(self.epoch)
+
 
     def kill_workers(self):
-        """Flood the task queue with Terminate control messages. Workers will 
-        terminate after completing their current task."""
-        for host in self.hosts:
-            self._task_queue.put(("TERM",))
+        """Queue a Terminate control message behind the queued tasks. Each
+        worker puts it back before exiting, so that it reaches every worker,
+        and workers will terminate after completing their current task."""
+        self._task_queue.put_many([("TERM",)])
 
     
     def join(self):
-        while self.running_workers > 0:
-            time.sleep(1)
+        """Wait for every launcher to report, and for every worker launched to
+        terminate, or to be lost. Wakes as soon as the last one does."""
+        with self._status:
+            while not self._finished:
+                self._status.wait(60)
+        if self._launcher:
+            self._launcher.join()
+
+
+# The queues of the Bullpen served by this process, set up by run_worker
+_res_queue = None
+_board     = None
+_handlers  = []
+_launch_handlers = []
+
+# The latest epoch cancelled by the Bullpen, and that of the running task,
+# and whether the running task was handed out again after its worker was lost
+_epoch        = 0
+_task_epoch   = 0
+_task_retried = False
+
+def emit(result):
+    """Send `result` to the Bullpen from inside a running task, without
+    waiting for the task to finish. Unlike the task's return value, emitted
+    results do not complete the task's handle."""
+    _res_queue.put(("RESULT", result))
+
+
+def post(notice):
+    """Broadcast `notice` to every worker of the Bullpen, this one included"""
+    _board.post(notice)
+
 
+def cancelled():
+    """Return True if the running task has been cancelled. This is cheap
+    enough to check between blocks of guesses."""
+    return _task_epoch < _epoch
 
-def run_worker(modpath, host, port, queue_id):
+
+def retried():
+    """Return True if the running task was handed out before, to a worker
+    which was lost, so that part of it may have been run already"""
+    return _task_retried
+
+
+def on_launch(handler):
+    """Register `handler` to be called with the id of each Bullpen whose
+    workers are about to be forked on this host. Handlers run in the
+    launcher, so that whatever they set up is shared by that Bullpen's
+    workers, and should be registered when the worker's module is
+    imported."""
+    _launch_handlers.append(handler)
+
+
+def _prepare_launch(queue_id):
+    """Call the launch handlers for the Bullpen `queue_id`"""
+    for handler in _launch_handlers:
+        handler(queue_id)
+
+
+def on_notice(handler):
+    """Register `handler` to be called with each notice broadcast to this
+    worker. Handlers run on a background thread, and should be registered when
+    the worker's module is imported."""
+    _handlers.append(handler)
+
+
+def _watch_board(board):
+    """Pass each notice posted to `board` to the registered handlers, until
+    the connection to the Manager is lost. Cancellations are handled here
+    rather than passed on."""
+    global _epoch
+    seen = 0
+    while True:
+        try:
+            notices = board.since(seen, None)
+        except (EOFError, IOError):
+            return
+        seen += len(notices)
+        for notice in notices:
+            if notice[0] == "CANCEL":
+                _epoch = max(_epoch, notice[1])
+                continue
+            for handler in _handlers:
+                handler(notice)
+
+
+def run_workers(modpath, host, port, queue_id, processes=1, prefetch=1,
+        result_batch=1, lease=None, metrics_interval=10, authkey=None,
+        transport="manager", channels=None, report=True):
+    """Run `processes` workers on this host, or one per core if it is "auto",
+    and wait for them to exit.
+
+    This function will be invoked by the related Bullpen object when it ssh's
+    into the worker host. The worker's module is imported before the workers
+    are forked, so that anything it loads is shared between them. The
+    launcher reports how many workers it forks to the Bullpen, or why it
+    could not fork any, unless `report` is False, as when the Bullpen runs it
+    locally. With the shm transport, `channels` holds each worker's ends of
+    its rings.
+    """
+    if processes == "auto":
+        processes = multiprocessing.cpu_count()
+    res_queue = None
+    if report:
+        res_queue = _connect(host, port, queue_id, authkey, transport,
+            None)[1]
+    try:
+        if pydoc.locate(modpath) is None:
+            raise ImportError("No target named {}".format(modpath))
+    except BaseException:
+        if res_queue is not None:
+            res_queue.put(("STATUS", {"event": "failed",
+                "host": socket.getfqdn(), "error": traceback.format_exc()}))
+        raise
+    if res_queue is not None:
+        res_queue.put(("STATUS", {"event": "launched",
+            "host": socket.getfqdn(), "workers": processes}))
+
+    _prepare_launch(queue_id)
+    channels = channels or [None] * processes
+    children = [
+        _fork_worker(modpath, host, port, queue_id, prefetch, result_batch,
+            lease, metrics_interval, authkey, transport, channels[i])
+        for i in range(processes)
+    ]
+    for pid in children:
+        os.waitpid(pid, 0)
+
+
+def _connect(host, port, queue_id, authkey, transport, channels):
+    """Return the task queue, result queue and notice board of the Bullpen,
+    reached through `transport`"""
+    if authkey is None:
+        authkey = getenv("BULLPEN_AUTHKEY")
+    if transport == "manager":
+        man = BullpenManager(address=(host, int(port)), authkey=authkey)
+        man.connect()
+        BullpenManager.register("get_t{}".format(queue_id))
+        BullpenManager.register("get_r{}".format(queue_id))
+        BullpenManager.register("get_b{}".format(queue_id))
+        return (getattr(man, "get_t{}".format(queue_id))(),
+            getattr(man, "get_r{}".format(queue_id))(),
+            getattr(man, "get_b{}".format(queue_id))())
+
+    # Each thread of the worker calls over its own connection, or its own
+    # pair of rings
+    if transport == "socket":
+        connect = lambda: _nodelay_client((host, int(port) + 1),
+            authkey=authkey)
+    else:
+        connect = list(channels).pop
+    client = RpcClient(connect)
+    return tuple(RemoteObject(client, name + queue_id) for name in "trb")
+
+
+def _fork_worker(*args):
+    """Fork a process which runs `run_worker` with `args`, and return its
+    pid"""
+    pid = os.fork()
+    if pid == 0:
+        status = 0
+        try:
+            run_worker(*args)
+        except BaseException:
+            traceback.print_exc()
+            status = 1
+        os._exit(status)
+    return pid
+
+
+def _heartbeat(task_queue, res_queue, worker_id, lease, metrics_interval,
+        stop):
+    """Renew the worker's leases three times per `lease` period, if it has
+    one, and report its telemetry every `metrics_interval` seconds, until
+    `stop` is set or the connection to the Manager is lost"""
+    interval = metrics_interval
+    if lease:
+        interval = min(interval, lease / 3.0)
+    reported = time.time()
+    while not stop.wait(interval):
+        try:
+            if lease:
+                task_queue.renew(worker_id)
+            if time.time() - reported >= metrics_interval:
+                res_queue.put(("METRICS", telemetry.report(worker_id)))
+                reported = time.time()
+        except (EOFError, IOError):
+            return
+
+
+def run_worker(modpath, host, port, queue_id, prefetch=1, result_batch=1,
+        lease=None, metrics_interval=10, authkey=None, transport="manager",
+        channels=None):
     """Execute queued tasks using the provided worker function.
     
-    This funtion will be invoked by the related Bullpen object when it ssh's 
-    into the worker host. It wraps the worker function to connect and provide 
-    access to the Bullpen's task and result queues.
+    This funtion is invoked by `run_workers` for each worker process. It wraps
+    the worker function to connect and provide access to the Bullpen's task
+    and result queues. The Manager's `authkey` is read from the
+    BULLPEN_AUTHKEY environment variable if it is not given.
     """
-    # Connect to the Manager Server
-    authkey = getenv("BULLPEN_AUTHKEY")
-    man = BullpenManager(address=(host, int(port)), authkey=authkey)
-    man.connect()
-    
-    # Load the task and result queues, as well as the worker callable
+    # Load the task and result queues and the notice board, as well as the
+    # worker callable
+    global _res_queue, _board, _task_epoch, _task_retried
     worker = pydoc.locate(modpath)
-    BullpenManager.register("get_t{}".format(queue_id))
-    BullpenManager.register("get_r{}".format(queue_id))
-    task_queue = getattr(man, "get_t{}".format(queue_id))()
-    res_queue  = getattr(man, "get_r{}".format(queue_id))()
+    task_queue, res_queue, _board = _connect(host, port, queue_id, authkey,
+        transport, channels)
+    _res_queue = res_queue
+
+    watcher = threading.Thread(target=_watch_board, args=(_board,))
+    watcher.daemon = True
+    watcher.start()
 
     # Report successful startup
-    res_queue.put(("STATUS",
-        "{}: worker started.".format(socket.getfqdn())
-    ))
+    worker_id = "{}:{}".format(socket.getfqdn(), os.getpid())
+    res_queue.put(("STATUS", {"event": "started", "worker": worker_id}))
+    telemetry.reset()
+
+    # Renew the leases on this worker's tasks and report its telemetry from
+    # a background thread, so that neither waits for a long task
+    stop = threading.Event()
+    heartbeat = threading.Thread(target=_heartbeat,
+        args=(task_queue, res_queue, worker_id, lease, metrics_interval, stop)
+    )
+    heartbeat.daemon = True
+    heartbeat.start()
         
-    # Run the event loop
+    # Run the event loop, holding up to `prefetch` tasks locally and sending
+    # results in batches, flushing them before waiting on the task queue. The
+    # ids of the tasks completed, or skipped as cancelled, are sent with them.
+    tasks, results, done = collections.deque(), [], []
+    def flush():
+        if done:
+            results.append(("DONE", done[:]))
+            del done[:]
+        res_queue.put_many(results)
+        del results[:]
+
     while True:
-        task = task_queue.get()
+        if not tasks:
+            if results or done:
+                flush()
+            waited = time.time()
+            tasks.extend(task_queue.get_many(prefetch, None, worker_id))
+            telemetry.add("idle_seconds", time.time() - waited)
+
+        task = tasks.popleft()
         if task[0] == "TASK":
-            args, kwargs = task[1:]
-            res = worker(*args, **kwargs)
-            if res != None:
-                res_queue.put(("RESULT", res))
+            if task[3] >= _epoch:
+                args, kwargs, _task_epoch = task[1:4]
+                _task_retried = len(task) > 5
+                started = time.time()
+                res = worker(*args, **kwargs)
+                telemetry.add("task_seconds", time.time() - started)
+                telemetry.add("tasks")
+                if res != None:
+                    results.append(("RESULT", res, task[4]))
+            done.append(task[4])
+            if len(results) >= result_batch:
+                flush()
         if task[0] == "TERM":
-            res_queue.put(("STATUS", "Got TERM task. Terminating."))
+            task_queue.put(task)
+            stop.set()
+            heartbeat.join()
+            if lease:
+                task_queue.retire(worker_id)
+            results.append(("METRICS", telemetry.report(worker_id)))
+            results.append(
+                ("STATUS", {"event": "terminated", "worker": worker_id})
+            )
+            flush()
             break
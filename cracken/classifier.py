@@ -7,87 +7,290 @@
     structures, based on the passwords.
 
     Can be invoked directly as `python cracken/classifier.py passwords.txt` to
-    classify the contents of `passwords.txt`. 
+    classify the contents of `passwords.txt`. The raw counts behind the
+    profiling can be saved with `--profile`, and later updated with new
+    passwords or merged with profiles built elsewhere:
+
+        python cracken/classifier.py --profile leaks.prof old_leak.txt
+        python cracken/classifier.py --update leaks.prof new_leak.txt
+        python cracken/classifier.py --merge a.prof b.prof --profile all.prof
 """
 import collections
-import functools
+import itertools
+import multiprocessing
+import os
 import re
+import string
 
-def classify(wordfile, structfile="base_structs.txt", 
-        grammarfile="prob_grammar.txt", glossaryfile="glossary.txt"):
-    """Generates profiling information for other cracken utilities.
+# Translation table mapping every byte to the class of character it belongs
+# to: upper-case letters are C, lower-case letters and apostrophes are L,
+# digits are D, and everything else is S
+_TOKEN_TABLE = "".join(
+    "C" if c in string.ascii_uppercase else
+    "L" if c in string.ascii_lowercase + "'" else
+    "D" if c in string.digits else
+    "S"
+    for c in map(chr, range(256))
+)
 
-    Reads plaintext passwords from `wordfile`, and uses them to generate
-    a glossary, as well as a collection of base structures ordered by 
-    probability and a probabilistic grammar mapping to the non-terminals in the 
-    base structures. Parameters control the file names to which profiling will 
-    be written.
+
+_find_runs = re.compile(r"C+|L+|D+|S+").findall
+
+
+def tokenize(word):
+    """Return the non-terminals making up `word`, e.g. "pass123" becomes
+    ["L4", "D3"]. Joined with '|', these form the word's base structure."""
+    return [
+        run[0] + str(len(run))
+        for run in _find_runs(word.translate(_TOKEN_TABLE))
+    ]
+
+
+class Profile(object):
+    """Raw counts of the base structures, grammar terminals and glossary words
+    seen in a collection of passwords.
+
+    Profiles of different collections can be merged, saved to and loaded from
+    a profile file, and exported as the normalized probabilities used by the
+    other cracken utilities. The order in which keys were first seen is
+    tracked, so that a merged profile writes exactly what a single pass over
+    all of the words would.
     """
-    bases = collections.defaultdict(float)
-    gloss = collections.defaultdict(set)
-    probs = collections.defaultdict(
-        functools.partial(collections.defaultdict, float)
-    )
-
-    total = 0
-
-    # Parse the words
-    with open(wordfile) as f:
-        for word in f:
-            total += 1
-            word = word.strip()
-
-            # Tokenize the input string
-            s = re.sub(r'[A-Z]', r'C', word)
-            s = re.sub(r"[a-z']", r'L', s)
-            s = re.sub(r'[0-9]', r'D', s)
-            s = re.sub(r'[_\W]',  r'S', s)
-            
-            #print s
-            # Reduce the string, i.e. "LLLLDDD"->"L4D3"
-            new, prev, cnt = s[0], s[0], 1
-            for c in s[1:]:
-                if c != prev:
-                    new += str(cnt) + '|' + c
-                    cnt = 0
-                cnt += 1
-                prev = c
-            
-            new += str(cnt)
-            bases[new] += 1
-
-            # Parse the string components into the probability structures
-            i = 0
-            for ident in new.split('|'):
-                cnt = int(ident[1:])
-                if ident[0] == "L":
-                    gloss[cnt].add(word[i:i+cnt])
+    def __init__(self):
+        self.total = 0
+        self.bases = {}
+        self.gloss = collections.defaultdict(dict)
+        self.probs = collections.defaultdict(dict)
+        self._base_order = []
+        self._prob_order = collections.defaultdict(list)
+
+
+    def add(self, word):
+        """Count a single password"""
+        self.total += 1
+        idents = tokenize(word)
+        struct = "|".join(idents)
+        if struct in self.bases:
+            self.bases[struct] += 1
+        else:
+            self.bases[struct] = 1
+            self._base_order.append(struct)
+
+        # Parse the string components into the probability structures
+        i = 0
+        for ident in idents:
+            cnt = int(ident[1:])
+            term = word[i:i+cnt]
+            if ident[0] == "L":
+                words = self.gloss[cnt]
+                words[term] = words.get(term, 0) + 1
+            else:
+                counts = self.probs[ident]
+                if term in counts:
+                    counts[term] += 1
                 else:
-                    probs[ident][word[i:i+cnt]] += 1
-                i += cnt
+                    counts[term] = 1
+                    self._prob_order[ident].append(term)
+            i += cnt
 
-    # Write the base structures with their probabilities
-    with open(structfile, "w") as f:
+
+    def merge(self, other):
+        """Add the counts from `other` to this profile"""
+        self.total += other.total
+        for struct in other._base_order:
+            if struct not in self.bases:
+                self.bases[struct] = 0
+                self._base_order.append(struct)
+            self.bases[struct] += other.bases[struct]
+
+        for length, other_words in other.gloss.items():
+            words = self.gloss[length]
+            for word, cnt in other_words.items():
+                words[word] = words.get(word, 0) + cnt
+
+        for nterm, terms in other._prob_order.items():
+            counts, other_counts = self.probs[nterm], other.probs[nterm]
+            for term in terms:
+                if term not in counts:
+                    counts[term] = 0
+                    self._prob_order[nterm].append(term)
+                counts[term] += other_counts[term]
+
+
+    @classmethod
+    def load(cls, fname):
+        """Load a profile saved with `save`"""
+        profile = cls()
+        with open(fname, "rb") as f:
+            for line in f:
+                kind, rest = line.rstrip("\n").split("\t", 1)
+                if kind == "T":
+                    profile.total = int(rest)
+                elif kind == "B":
+                    cnt, struct = rest.split("\t", 1)
+                    profile.bases[struct] = int(cnt)
+                    profile._base_order.append(struct)
+                elif kind == "G":
+                    nterm, cnt, term = rest.split("\t", 2)
+                    profile.probs[nterm][term] = int(cnt)
+                    profile._prob_order[nterm].append(term)
+                elif kind == "W":
+                    cnt, word = rest.split("\t", 1)
+                    profile.gloss[len(word)][word] = int(cnt)
+        return profile
+
+
+    def save(self, fname):
+        """Save the raw counts to `fname`. Each line is a tab separated record,
+        with the key last so that it may contain whitespace."""
+        with open(fname, "wb") as f:
+            f.write("T\t{}\n".format(self.total))
+            for struct in self._base_order:
+                f.write("B\t{}\t{}\n".format(self.bases[struct], struct))
+            for nterm in sorted(self._prob_order):
+                counts = self.probs[nterm]
+                for term in self._prob_order[nterm]:
+                    f.write("G\t{}\t{}\t{}\n".format(nterm, counts[term], term))
+            for length in sorted(self.gloss):
+                words = self.gloss[length]
+                for word in sorted(words):
+                    f.write("W\t{}\t{}\n".format(words[word], word))
+
+
+    def base_structs(self):
+        """Yield `(struct, prob)` for each base structure, most likely first"""
+        bases = self.bases
         for c in sorted(bases, key=bases.get, reverse=True):
-            f.write("{:20} {}\n".format(c, bases[c]/total))
-
-    # Write the glossary
-    with open(glossaryfile, "w") as f:
-        for length in sorted(gloss):
-            for word in sorted(gloss[length]):
-                f.write("{:3} {}\n".format(length, word))
-
-    # Write the probabilistic grammar
-    with open(grammarfile, "w") as f:
-        for nterm in sorted(probs):
-            total = sum(probs[nterm].values())
-            for term in sorted(probs[nterm], key=probs[nterm].get, reverse=True):
-                f.write("{:3} {:10} {}\n".format(nterm, term, probs[nterm][term]/total))
-            
-            
+            yield c, float(bases[c])/self.total
+
+
+    def grammar(self):
+        """Yield `(nterm, term, prob)` for each terminal in the grammar, with
+        the terminals of each non-terminal ordered most likely first"""
+        for nterm in sorted(self.probs):
+            counts = self.probs[nterm]
+            total = sum(counts.values())
+            for term in sorted(counts, key=counts.get, reverse=True):
+                yield nterm, term, float(counts[term])/total
+
+
+    def glossary(self):
+        """Yield `(length, word, prob)` for each word in the glossary, where
+        `prob` is the frequency of the word among words of its length. The
+        words of each length are ordered most frequent first."""
+        for length in sorted(self.gloss):
+            words = self.gloss[length]
+            total = sum(words.values())
+            for word in sorted(words, key=lambda w: (-words[w], w)):
+                yield length, word, float(words[word])/total
+
+
+    def write(self, structfile="base_structs.txt",
+            grammarfile="prob_grammar.txt", glossaryfile="glossary.txt"):
+        """Write the base structures, glossary and grammar with their
+        normalized probabilities"""
+        with open(structfile, "w") as f:
+            for c, prob in self.base_structs():
+                f.write("{:20} {}\n".format(c, prob))
+
+        with open(glossaryfile, "w") as f:
+            for length, word, prob in self.glossary():
+                f.write("{:3} {:10} {}\n".format(length, word, prob))
+
+        with open(grammarfile, "w") as f:
+            for nterm, term, prob in self.grammar():
+                f.write("{:3} {:10} {}\n".format(nterm, term, prob))
+
+
+def split_file(fname, chunk_size):
+    """Split `fname` into (start, stop) byte ranges of about `chunk_size`
+    bytes, each of which begins at the start of a line"""
+    size = os.path.getsize(fname)
+    bounds = [0]
+    with open(fname, "rb") as f:
+        while bounds[-1] + chunk_size < size:
+            f.seek(bounds[-1] + chunk_size)
+            f.readline()
+            if f.tell() >= size:
+                break
+            bounds.append(f.tell())
+    bounds.append(size)
+    return zip(bounds[:-1], bounds[1:])
+
+
+def classify_chunk(args):
+    """Return a Profile of the passwords in the byte range [start, stop) of
+    `wordfile`, given as the tuple `(wordfile, start, stop)`"""
+    wordfile, start, stop = args
+    profile = Profile()
+    with open(wordfile, "rb") as f:
+        f.seek(start)
+        pos = start
+        while pos < stop:
+            line = f.readline()
+            if not line:
+                break
+            pos += len(line)
+            word = line.strip()
+            if word:
+                profile.add(word)
+    return profile
+
+
+def profile_file(wordfile, processes=None, chunk_size=1<<26):
+    """Return a Profile of the passwords in `wordfile`. The file is split into
+    chunks of about `chunk_size` bytes which are counted by a pool of
+    `processes` worker processes, by default one per core."""
+    chunks = [(wordfile, start, stop)
+        for start, stop in split_file(wordfile, chunk_size)]
+    if processes == 1 or len(chunks) < 2:
+        profiles = itertools.imap(classify_chunk, chunks)
+    else:
+        pool = multiprocessing.Pool(processes)
+        profiles = pool.imap(classify_chunk, chunks)
+        pool.close()
+
+    profile = Profile()
+    for chunk_profile in profiles:
+        profile.merge(chunk_profile)
+    return profile
+
+
+def classify(wordfile, structfile="base_structs.txt",
+        grammarfile="prob_grammar.txt", glossaryfile="glossary.txt",
+        processes=None):
+    """Generates profiling information for other cracken utilities.
+
+    Reads plaintext passwords from `wordfile`, and uses them to generate
+    a glossary, as well as a collection of base structures ordered by
+    probability and a probabilistic grammar mapping to the non-terminals in the
+    base structures. Parameters control the file names to which profiling will
+    be written, and the number of processes used to read the passwords.
+    """
+    profile = profile_file(wordfile, processes)
+    profile.write(structfile, grammarfile, glossaryfile)
+
+
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
-    parser.add_argument("passfile")
+    parser.add_argument("passfiles", nargs="*")
+    parser.add_argument("-j", "--processes", type=int, default=None,
+        help="number of worker processes, defaults to the number of cores")
+    parser.add_argument("-u", "--update", metavar="PROFILE",
+        help="add the passwords to an existing profile, saved in place")
+    parser.add_argument("-m", "--merge", metavar="PROFILE", nargs="+",
+        default=[], help="merge existing profiles into the result")
+    parser.add_argument("-p", "--profile",
+        help="save the raw counts to this profile file")
     args = parser.parse_args()
-    classify(args.passfile)
+
+    profile = Profile.load(args.update) if args.update else Profile()
+    for fname in args.merge:
+        profile.merge(Profile.load(fname))
+    for fname in args.passfiles:
+        profile.merge(profile_file(fname, args.processes))
+
+    if args.profile or args.update:
+        profile.save(args.profile or args.update)
+    profile.write()
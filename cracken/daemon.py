@@ -0,0 +1,282 @@
+"""
+    cracken.daemon
+    ~~~~~~~~~~~~~~
+
+    This module implements the WorkerDaemon, a long-lived process which stays
+    resident on a host and runs the jobs of whichever head is active, so that
+    back-to-back sessions don't pay for starting their workers afresh.
+
+    The daemon polls the head's address until a Manager answers with the
+    shared authkey, then waits on the Manager's job board for Bullpens created
+    with `daemons=True`. Each job is run by forking its worker processes, as
+    `run_workers` does, until they receive TERM. When the head goes away, the
+    daemon goes back to polling for the next one.
+
+    Target modules are imported by launchers, processes forked from the
+    daemon for each version of a target. A version is identified by the
+    content hash of the module's source, together with the files the job
+    names as its resources, such as its glossary. The launcher of a version
+    keeps the module and whatever it loaded at import time, and forks the
+    workers of every job for that version, so a job whose target and profile
+    are unchanged starts without importing anything. Editing the module or
+    swapping in a new profile changes the hash, and the next job starts a new
+    launcher, without restarting the daemon. The launchers of the most
+    recently used `max_targets` versions are kept.
+
+    Module state persists between the jobs of a version, as it would between
+    the tasks of a single session. Run a daemon on each host with:
+
+        BULLPEN_AUTHKEY=... python -m cracken.daemon head.example.org:8000
+"""
+from __future__ import absolute_import
+
+from collections                import OrderedDict
+from multiprocessing            import AuthenticationError
+from os                         import getenv
+
+from .bullpen                   import (BullpenManager, _fork_worker,
+                                    _prepare_launch)
+
+import hashlib
+import multiprocessing
+import os
+import pkgutil
+import pydoc
+import signal
+import socket
+import sys
+import time
+import traceback
+
+BullpenManager.register("get_jobs")
+
+def _module_files(modpath):
+    """Return the source files of the modules and packages on `modpath`,
+    without importing the module itself"""
+    files, parts = [], modpath.split(".")
+    for i in range(1, len(parts) + 1):
+        name = ".".join(parts[:i])
+        loader = pkgutil.find_loader(name)
+        if loader is None:
+            break
+        files.append(loader.get_filename())
+        if not loader.is_package(name):
+            break
+    return files
+
+
+def digest(modpath, resources=()):
+    """Return the content hash of the target `modpath` and the files in
+    `resources`, relative to the current directory"""
+    sha = hashlib.sha1()
+    for fname in _module_files(modpath) + list(resources):
+        sha.update(fname + "\0")
+        try:
+            with open(fname, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), ""):
+                    sha.update(chunk)
+        except IOError:
+            sha.update("\0missing")
+        sha.update("\0")
+    return sha.hexdigest()
+
+
+def _launcher(modpath, host, port, authkey, conn):
+    """Import the target `modpath`, then fork the workers of each job sent
+    over `conn`, and report back once they have all exited. Exits when told
+    to, or when the daemon does."""
+    try:
+        if pydoc.locate(modpath) is None:
+            raise ImportError("No target named {}".format(modpath))
+    except BaseException:
+        conn.send(traceback.format_exc())
+        return
+    conn.send(None)
+
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            return
+        if job is None:
+            return
+        _prepare_launch(job["queue_id"])
+        pids = [
+            _fork_worker(modpath, host, port, job["queue_id"],
+                job["prefetch"], job["result_batch"], job["lease"],
+                job["metrics_interval"], authkey, job["transport"])
+            for i in range(job["processes"])
+        ]
+        for pid in pids:
+            os.waitpid(pid, 0)
+        conn.send(None)
+
+
+class WorkerDaemon(object):
+    """Runs the jobs posted by the heads at `host` and `port`, connecting
+    with `authkey`, or the BULLPEN_AUTHKEY environment variable if it is not
+    given.
+
+    The address is polled every `poll` seconds while no head is answering.
+    If `processes` is given, it overrides the number of workers each job asks
+    for, and may be "auto" for one per core.
+    """
+    def __init__(self, host, port, authkey=None, processes=None, poll=5,
+            max_targets=4):
+        self.address = (host, int(port))
+        self.authkey = authkey or getenv("BULLPEN_AUTHKEY")
+        self.processes = processes
+        self.poll = poll
+        self.max_targets = max_targets
+        self.jobs_run = 0
+        self._launchers = OrderedDict()
+        self._done = set()
+        self._manager = None
+
+
+    def _log(self, msg):
+        sys.stdout.write("{} {}\n".format(time.strftime("%Y-%m-%d %H:%M:%S"),
+            msg))
+        sys.stdout.flush()
+
+
+    def serve_forever(self):
+        """Run jobs from each head in turn, polling for the next head whenever
+        the connection is lost"""
+        while True:
+            try:
+                self._serve()
+            except (EOFError, IOError) as e:
+                self._log("head unavailable: {}".format(e))
+            except AuthenticationError as e:
+                self._log("head refused the authkey: {}".format(e))
+            time.sleep(self.poll)
+
+
+    def _serve(self):
+        """Connect to the head and run each job posted to its board, until the
+        connection is lost"""
+        man = BullpenManager(address=self.address, authkey=self.authkey)
+        man.connect()
+        self._manager = man
+        jobs = man.get_jobs()
+        self._log("connected to {}:{}".format(*self.address))
+
+        seen = 0
+        while True:
+            posted = jobs.since(seen, self.poll)
+            seen += len(posted)
+            for job in posted:
+                if job["queue_id"] not in self._done:
+                    self._done.add(job["queue_id"])
+                    self.run_job(job)
+
+
+    def _get_launcher(self, job):
+        """Return the connection to the launcher of the current version of
+        `job`'s target, starting one if there is none. Raises ImportError if
+        the target can't be imported."""
+        os.chdir(job["cwd"])
+        key = (job["cwd"], job["target"],
+            digest(job["target"], job["resources"]))
+        if key in self._launchers:
+            self._launchers[key] = self._launchers.pop(key)
+            return self._launchers[key][1]
+
+        parent, child = multiprocessing.Pipe()
+        proc = multiprocessing.Process(target=_launcher,
+            args=(job["target"], self.address[0], self.address[1],
+                self.authkey, child)
+        )
+        proc.daemon = True
+        proc.start()
+        error = parent.recv()
+        if error:
+            proc.join()
+            raise ImportError("can't load {}:\n{}".format(job["target"],
+                error))
+
+        self._log("loaded {} ({})".format(job["target"], key[2][:12]))
+        self._launchers[key] = (proc, parent)
+        while len(self._launchers) > self.max_targets:
+            self._retire(self._launchers.popitem(last=False)[1])
+        return parent
+
+
+    def _report(self, job, event):
+        """Send the status `event` to the Bullpen which posted `job`"""
+        get_res_queue = "get_r{}".format(job["queue_id"])
+        BullpenManager.register(get_res_queue)
+        getattr(self._manager, get_res_queue)().put(("STATUS", event))
+
+
+    def _retire(self, launcher):
+        proc, conn = launcher
+        conn.send(None)
+        proc.join()
+
+
+    def run_job(self, job):
+        """Run `job`'s workers on this host, and wait for them to exit. A job
+        which can't be set up here, because its directory is missing or its
+        target can't be imported, is dropped and reported to the head."""
+        try:
+            conn = self._get_launcher(job)
+        except (EnvironmentError, ImportError) as e:
+            self._log("dropped job {}: {}".format(job["queue_id"], e))
+            self._report(job, {"event": "failed", "host": socket.getfqdn(),
+                "error": str(e)})
+            return
+        if self.processes is not None:
+            job = dict(job, processes=self.processes)
+        if job["processes"] == "auto":
+            job = dict(job, processes=multiprocessing.cpu_count())
+        self._report(job, {"event": "launched", "host": socket.getfqdn(),
+            "workers": job["processes"]})
+        self._log("running {} for job {}".format(job["target"],
+            job["queue_id"]))
+        started = time.time()
+        conn.send(job)
+        conn.recv()
+        self.jobs_run += 1
+        self._log("job {} finished after {:.1f}s".format(job["queue_id"],
+            time.time() - started))
+
+
+    def shutdown(self):
+        """Stop every launcher"""
+        while self._launchers:
+            self._retire(self._launchers.popitem()[1])
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("head", help="address of the head, as host:port")
+    parser.add_argument("-p", "--processes",
+        help="workers per job, or \"auto\" for one per core; by default as "
+            "many as each job asks for")
+    parser.add_argument("--poll", type=float, default=5,
+        help="seconds between attempts to reach the head")
+    parser.add_argument("--targets", type=int, default=4,
+        help="number of target versions kept loaded")
+    parser.add_argument("--authkey-file",
+        help="file holding the Manager's authkey, instead of BULLPEN_AUTHKEY")
+    args = parser.parse_args()
+
+    host, _, port = args.head.rpartition(":")
+    authkey = None
+    if args.authkey_file:
+        with open(args.authkey_file) as f:
+            authkey = f.read().strip()
+    processes = args.processes
+    if processes not in (None, "auto"):
+        processes = int(processes)
+
+    daemon = WorkerDaemon(host, port, authkey, processes, args.poll,
+        args.targets)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        daemon.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        daemon.shutdown()
@@ -0,0 +1,236 @@
+"""
+    cracken.estimator
+    ~~~~~~~~~~~~~~~~~
+
+    This module implements the GuessEstimator class, which estimates how many
+    guesses cracken needs before it guesses a password, without generating
+    them.
+
+    A password's probability under the model is that of its base structure,
+    times that of each of its terminals in the grammar, and of each of its
+    words in the glossary, as the PreTerminalHeap computes it when filling L
+    slots from a glossary. Guesses are made in order of decreasing
+    probability, so a password's guess number is the number of guesses more
+    probable than it. This is estimated by Monte Carlo sampling, after Dell'Amico
+    and Filippone, "Monte Carlo Strength Evaluation" (CCS 2015): given `n`
+    guesses drawn from the model, each with probability `p_i`, the number of
+    guesses with probability above `p` is estimated by the sum of
+    `1 / (n * p_i)` over the samples with `p_i > p`. With the samples sorted
+    and the sums accumulated once, each estimate is a single binary search.
+
+    Mangling rules are not part of the model, so the estimates count the
+    guesses made before mangling.
+
+    Can be invoked directly to estimate the guess numbers of passwords, or the
+    coverage of a test set at increasing numbers of guesses:
+
+        python -m cracken.estimator password1 hunter2
+        python -m cracken.estimator --coverage test_set.txt
+"""
+from __future__ import absolute_import
+
+from .classifier    import _TOKEN_TABLE, tokenize
+from .generator     import read_glossary, read_rows
+
+import bisect
+import math
+import random
+import sys
+
+class _Table(object):
+    """The terminals of a non-terminal with their negative log-probabilities,
+    normalized over the table, and the cumulative probabilities used to
+    sample from it"""
+    __slots__ = ("costs", "cumulative")
+
+    def __init__(self, rows):
+        total = sum(prob for _, prob in rows)
+        self.costs, self.cumulative, running = {}, [], 0.0
+        for term, prob in rows:
+            self.costs[term] = -math.log(prob / total)
+            running += prob / total
+            self.cumulative.append((running, term))
+
+
+    def sample(self, rng):
+        """Return the cost of a terminal drawn from the table"""
+        idx = bisect.bisect_left(self.cumulative, (rng.random(),))
+        return self.costs[self.cumulative[min(idx, len(self.cumulative) - 1)][1]]
+
+
+class GuessEstimator(object):
+    """Estimates the guess numbers of passwords under a profile.
+
+    The base structures, grammar and glossary may be given as file names or
+    rows, as for the PreTerminalHeap. `samples` guesses are drawn from the
+    model with the random `seed`; the relative error of the estimates shrinks
+    as one over the square root of the number of samples.
+
+    Base structures with a slot which neither the grammar nor the glossary
+    can fill are never guessed, and are left out of the model.
+    """
+    def __init__(self, base_structs, prob_grammar, glossary, samples=100000,
+            seed=0):
+        grammar = {}
+        for nterm, term, prob in read_rows(prob_grammar):
+            grammar.setdefault(nterm, []).append((term, float(prob)))
+        for nterm, words in read_glossary(glossary).items():
+            grammar[nterm] = [(word, math.exp(-cost)) for word, cost in words]
+        self._tables = dict(
+            (nterm, _Table(rows)) for nterm, rows in grammar.items()
+        )
+
+        bases = [(struct, float(prob))
+            for struct, prob in read_rows(base_structs)
+            if all(nt in self._tables for nt in struct.split("|"))]
+        self._bases = _Table(bases)
+        self._nterms = dict(
+            (struct, struct.split("|")) for struct, _ in bases
+        )
+        self._plans = {}
+        self._sample(samples, seed)
+
+
+    def _sample(self, n, seed):
+        """Draw `n` guesses from the model, and accumulate the estimated
+        number of guesses more probable than each, in order of cost"""
+        rng = random.Random(seed)
+        bases, tables, nterms = self._bases, self._tables, self._nterms
+        costs = []
+        for _ in xrange(n):
+            idx = bisect.bisect_left(bases.cumulative, (rng.random(),))
+            struct = bases.cumulative[min(idx, len(bases.cumulative) - 1)][1]
+            cost = bases.costs[struct]
+            for nt in nterms[struct]:
+                cost += tables[nt].sample(rng)
+            costs.append(cost)
+        costs.sort()
+
+        # ranks[k] estimates the number of guesses more probable than the
+        # k'th most probable sample
+        self._costs, self._ranks, total = costs, [0.0], 0.0
+        for cost in costs:
+            total += math.exp(cost) / n
+            self._ranks.append(total)
+
+
+    def _plan(self, password):
+        """Return the cost of the base structure of `password`, and the slice
+        of the password and the costs of the terminals for each of its slots.
+        Plans are cached by the classes of the password's characters, as most
+        passwords share a few hundred structures."""
+        classes = password.translate(_TOKEN_TABLE)
+        plan = self._plans.get(classes)
+        if plan is None:
+            idents = tokenize(password)
+            cost = self._bases.costs.get("|".join(idents))
+            slots, i = [], 0
+            if cost is not None:
+                for ident in idents:
+                    cnt = int(ident[1:])
+                    slots.append((i, i + cnt, self._tables[ident].costs))
+                    i += cnt
+            plan = self._plans[classes] = (cost, slots)
+        return plan
+
+
+    def cost(self, password):
+        """Return the negative log-probability of `password` under the
+        model, or None if the model can't generate it"""
+        cost, slots = self._plan(password)
+        if cost is None:
+            return None
+        for start, stop, costs in slots:
+            term_cost = costs.get(password[start:stop])
+            if term_cost is None:
+                return None
+            cost += term_cost
+        return cost
+
+
+    def prob(self, password):
+        """Return the probability of `password` under the model"""
+        cost = self.cost(password)
+        return 0.0 if cost is None else math.exp(-cost)
+
+
+    def guess_number(self, password):
+        """Return the estimated number of guesses made before `password` is
+        guessed, or None if it is never guessed"""
+        cost = self.cost(password)
+        if cost is None:
+            return None
+        return self._ranks[bisect.bisect_left(self._costs, cost)]
+
+
+    def guess_numbers(self, passwords):
+        """Return a list of the estimated guess numbers of `passwords`"""
+        return [self.guess_number(password) for password in passwords]
+
+
+    def coverage(self, passwords, budgets=None):
+        """Return `(guesses, fraction)` for each number of guesses in
+        `budgets`, where `fraction` is the fraction of `passwords` which would
+        be guessed within that many guesses. `budgets` defaults to the powers
+        of ten up to the largest estimate. An empty test set has no coverage,
+        and gives an empty list."""
+        total = len(passwords)
+        if not total:
+            return []
+        numbers = sorted(
+            n for n in self.guess_numbers(passwords) if n is not None
+        )
+        if budgets is None:
+            top = numbers[-1] if numbers else 1
+            budgets = [10 ** e
+                for e in range(int(math.ceil(math.log10(max(top, 1)))) + 1)]
+        return [
+            (guesses, float(bisect.bisect_right(numbers, guesses)) / total)
+            for guesses in budgets
+        ]
+
+
+    def guesses_to_cover(self, passwords, fraction):
+        """Return the estimated number of guesses needed to guess `fraction`
+        of `passwords`, or None if the model can't reach it"""
+        numbers = sorted(
+            n for n in self.guess_numbers(passwords) if n is not None
+        )
+        needed = int(math.ceil(fraction * len(passwords)))
+        if needed > len(numbers):
+            return None
+        return numbers[needed - 1] if needed else 0.0
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("passwords", nargs="*")
+    parser.add_argument("-c", "--coverage", metavar="TESTSET",
+        help="report the coverage of the passwords in this file")
+    parser.add_argument("-n", "--samples", type=int, default=100000,
+        help="number of guesses sampled from the model")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--base-structs", default="base_structs.txt")
+    parser.add_argument("--grammar", default="prob_grammar.txt")
+    parser.add_argument("--glossary", default="glossary.txt")
+    args = parser.parse_args()
+
+    estimator = GuessEstimator(args.base_structs, args.grammar, args.glossary,
+        args.samples, args.seed)
+    for password in args.passwords:
+        number = estimator.guess_number(password)
+        sys.stdout.write("{:20} {}\n".format(password,
+            "never" if number is None else "{:.3g}".format(number)))
+
+    if args.coverage:
+        with open(args.coverage) as f:
+            testset = [line.rstrip("\r\n") for line in f if line.strip()]
+        if not testset:
+            sys.exit("No passwords in {}".format(args.coverage))
+        for guesses, fraction in estimator.coverage(testset):
+            sys.stdout.write("{:>12.0e} {:7.2%}\n".format(guesses, fraction))
+        for fraction in (0.1, 0.25, 0.5):
+            needed = estimator.guesses_to_cover(testset, fraction)
+            sys.stdout.write("{:.0%} covered after {}\n".format(fraction,
+                "never" if needed is None else "{:.3g} guesses".format(needed)))
@@ -3,92 +3,502 @@
     ~~~~~~~~~~~~~~~~~
 
     This module implements the PreTerminalHeap class, which generates
-    preterminal guesses for likely password patterns.
+    preterminal guesses for likely password patterns, along with the
+    PreTerminal records it produces.
+
+    The ParallelPreTerminalHeap generates the same stream with several
+    processes. The base structures are dealt out between them, each process
+    expands its own share with a PreTerminalHeap, and the head merges their
+    streams by key, so the order is exactly that of a single heap. The head
+    is left with only the merge, a fraction of the cost of expanding the
+    preterminals, so the rate scales with the cores given to the processes.
 """
 from __future__ import absolute_import
 
-from collections    import defaultdict
+from collections    import defaultdict, namedtuple
+
+from .mapped        import MappedGlossary, MappedGrammar, is_compiled
 
 import heapq
+import itertools
+import marshal
+import math
+import multiprocessing
 import re
+import tempfile
+
+def read_rows(source, table=MappedGrammar):
+    """Yield the whitespace separated fields of each line of the file named
+    `source`, or the rows of a compiled `table`. Any other `source` is taken to
+    be an iterable of rows already."""
+    if not isinstance(source, basestring):
+        for row in source:
+            yield row
+        return
+
+    if is_compiled(source):
+        for row in table(source).rows():
+            yield row
+        return
+
+    with open(source) as f:
+        for line in f:
+            yield line.split()
+
+
+def read_glossary(source):
+    """Return a dictionary mapping each L non-terminal to a list of
+    `(word, cost)` tuples, where cost is the word's negative log-probability,
+    from a glossary file or rows. Words of a glossary without probabilities
+    are given equal probability."""
+    words = defaultdict(list)
+    for row in read_rows(source, MappedGlossary):
+        words["L{}".format(row[0])].append(
+            (row[1], float(row[2]) if len(row) > 2 else None)
+        )
+
+    glossary = {}
+    for nterm, terms in words.items():
+        uniform = math.log(len(terms))
+        glossary[nterm] = [
+            (word, uniform if prob is None else -math.log(prob))
+            for word, prob in terms
+        ]
+    return glossary
+
+
+def pivot(idxs):
+    """Return the position of the last non-zero index in `idxs`, or 0 if all
+    of the indices are zero. Only positions at or after the pivot may be
+    incremented when expanding `idxs`, which gives each index list a single
+    parent in the expansion tree."""
+    for i in reversed(range(len(idxs))):
+        if idxs[i]:
+            return i
+    return 0
+
+
+class PreTerminal(namedtuple("PreTerminal", ["segments", "logprob"])):
+    """A preterminal guess.
+
+    `segments` is a tuple of literal strings and integers, where each integer
+    is the length of an L slot to be filled with a word from the glossary.
+    `logprob` is the natural log of the preterminal's probability, or None if
+    it is not known. The string form, e.g. ``|L5|123!``, is the preterminal's
+    wire format.
+    """
+    __slots__ = ()
+    _slot_re = re.compile(r"\|L(\d+)\|")
+
+    @classmethod
+    def parse(cls, preterminal):
+        """Build a PreTerminal from its string form. The probability of a
+        parsed preterminal is not known."""
+        parts = cls._slot_re.split(preterminal)
+        segments = []
+        for i, part in enumerate(parts):
+            if i % 2:
+                segments.append(int(part))
+            elif part:
+                segments.append(part)
+        return cls(tuple(segments), None)
+
+
+    @property
+    def lens(self):
+        """The lengths of the L slots in this preterminal, in order"""
+        return [seg for seg in self.segments if isinstance(seg, int)]
+
+
+    @property
+    def prob(self):
+        if self.logprob is None:
+            return None
+        return math.exp(self.logprob)
+
+
+    def __str__(self):
+        return "".join(
+            "|L{}|".format(seg) if isinstance(seg, int) else seg
+            for seg in self.segments
+        )
+
+
+class BaseStructure(object):
+    """A base structure compiled against a probabilistic grammar.
+
+    The slot layout and the negative log-probability (the cost) of the
+    structure are computed once, so expanding a preterminal only has to look
+    up the chosen terminals.
+    """
+    __slots__ = ("nterms", "layout", "terms", "cost")
+
+    def __init__(self, nterms, prob, prob_grammar):
+        self.nterms = nterms
+        self.cost   = -math.log(prob)
+
+        # The layout holds the length of each L slot, and None for each slot
+        # filled from the grammar, whose terminals are kept in `terms`. L slots
+        # are only filled from the grammar if it has words for them.
+        self.layout = []
+        self.terms  = []
+        for nt in nterms:
+            if nt.startswith("L") and nt not in prob_grammar:
+                self.layout.append(int(nt[1:]))
+            else:
+                self.layout.append(None)
+                self.terms.append(prob_grammar[nt])
+
+
+    def calc_cost(self, nt_idxs):
+        """Return the negative log-probability of the preterminal given by
+        choosing terminal `nt_idxs[i]` for the i'th grammar slot"""
+        cost = self.cost
+        for terms, idx in zip(self.terms, nt_idxs):
+            cost += terms[idx][1]
+        return cost
+
+
+    def segments(self, nt_idxs):
+        """Return the segments of the preterminal given by `nt_idxs`, with
+        adjacent terminals joined into a single literal string"""
+        segments, literal, cur_nt_idx = [], "", 0
+        for slot in self.layout:
+            if slot is None:
+                terms = self.terms[cur_nt_idx]
+                literal += terms[nt_idxs[cur_nt_idx]][0]
+                cur_nt_idx += 1
+            else:
+                if literal:
+                    segments.append(literal)
+                    literal = ""
+                segments.append(slot)
+        if literal:
+            segments.append(literal)
+        return tuple(segments)
+
+
+class SpillRun(object):
+    """A sorted run of heap entries spilled to a temporary file, which is read
+    back one entry at a time"""
+    def __init__(self, entries, dir=None):
+        self._file = tempfile.TemporaryFile(dir=dir)
+        for entry in entries:
+            marshal.dump(entry, self._file)
+        self._file.seek(0)
+
+
+    def __iter__(self):
+        return self
+
+
+    def next(self):
+        try:
+            return marshal.load(self._file)
+        except EOFError:
+            self._file.close()
+            raise StopIteration()
+
 
 class PreTerminalHeap(object):
     """PreTerminalHeap objects generate a stream of preterminal guesses.
 
     Given a probablistic grammar, a PreTerminalHeap will generate a set of
-    preterminal guesses, which will be provided in order of decreasing 
-    probability.
+    preterminal guesses, which will be provided in order of decreasing
+    probability as PreTerminal records. The base structures and grammar may
+    be given as file names, or as iterables of `(struct, prob)` and
+    `(nterm, term, prob)` rows such as those exported by a Profile.
+
+    If a `glossary` is given, L slots are filled from it as though they were
+    grammar non-terminals, so the word probabilities are folded into the
+    ordering and each preterminal is a complete guess.
+
+    If `max_queue` is given, at most that many entries are kept in memory.
+    When the heap grows past it, the less likely half of the heap is spilled
+    to a sorted run file in `spill_dir`, and runs are merged back into the
+    stream as they are reached. Once there are more than `max_runs` runs,
+    they are merged into one.
+
+    Every preterminal has a key, `(cost, bs_idx, nt_idxs)`, and they are
+    generated in order of their keys. `last_key` is the key of the last
+    preterminal generated, and a new heap can `seek` to it to carry on from
+    where an earlier one left off.
+
+    If `partition` is given as `(i, n)`, only every n'th base structure,
+    starting from the i'th, is expanded. Keys keep the structures' indices,
+    so the heaps of partitions 0 to n-1 generate the whole stream between
+    them.
     """
-    def __init__(self, base_structs, prob_grammar):
+    def __init__(self, base_structs, prob_grammar, glossary=None,
+            max_queue=None, max_runs=64, spill_dir=None, partition=None):
+        self.partition = partition
         self._base_structs = []
         self._prob_grammar = defaultdict(list)
         self._queue = []
-        
-        with open(base_structs) as f:
-            for line in f:
-                struct, prob = line.split()       
-                self._base_structs.append(
-                    (struct.split('|'), float(prob))
-                )
-        
-        with open(prob_grammar) as f:
-            for line in f:
-                nterm, term, prob = line.split()
-                self._prob_grammar[nterm].append((term, float(prob)))
-                
-    
+        self._runs  = []
+        self._max_queue = max_queue
+        self._max_runs  = max_runs
+        self._spill_dir = spill_dir
+        self._seeded    = False
+        self.last_key   = None
+
+        # Grammar terminals are stored with their negative log-probabilities
+        for nterm, term, prob in read_rows(prob_grammar):
+            self._prob_grammar[nterm].append((term, -math.log(float(prob))))
+        if glossary is not None:
+            self._prob_grammar.update(read_glossary(glossary))
+
+        for struct, prob in read_rows(base_structs):
+            self._base_structs.append(BaseStructure(
+                struct.split('|'), float(prob), self._prob_grammar
+            ))
+
+
+    @classmethod
+    def from_profile(cls, profile, **kwargs):
+        """Build a PreTerminalHeap from the probabilities of a Profile"""
+        return cls(profile.base_structs(), profile.grammar(), **kwargs)
+
+
     def build_preterminal(self, bs_idx, nt_idxs):
         """Given a base structure index and an index for each non-terminal in
-        that base structure, return the resultant preterminal"""
-        res, cur_nt_idx = "", 0
-        for nt in self._base_structs[bs_idx][0]:
-            if "L" in nt:
-                res += '|{}|'.format(nt)
-            else:
-                res += self._prob_grammar[nt][nt_idxs[cur_nt_idx]][0]
-                cur_nt_idx += 1
-        return res
+        that base structure, return the resultant preterminal's string form"""
+        bs = self._base_structs[bs_idx]
+        return str(PreTerminal(bs.segments(nt_idxs), -bs.calc_cost(nt_idxs)))
 
 
     def calc_pt_prob(self, bs_idx, nt_idxs):
-        """Given a base structure index and an index for each non-terminal in 
+        """Given a base structure index and an index for each non-terminal in
         that base structure, return the probability of that the resultant
         preterminal"""
-        prod = 1
-        l = [nt for nt in self._base_structs[bs_idx][0] if "L" not in nt]
-        for nt, idx in zip(l, nt_idxs):
-            prod *= self._prob_grammar[nt][idx][1]
-        return prod
+        return math.exp(-self._base_structs[bs_idx].calc_cost(nt_idxs))
+
+
+    def _push(self, entry):
+        heapq.heappush(self._queue, entry)
+        if self._max_queue and len(self._queue) > self._max_queue:
+            self._spill()
+
+
+    def _spill(self):
+        """Move the less likely half of the in-memory heap to a new run. The
+        more likely half of a sorted list is still a valid heap."""
+        self._queue.sort()
+        keep = len(self._queue) // 2
+        self._add_run(SpillRun(self._queue[keep:], self._spill_dir))
+        del self._queue[keep:]
+
+        if len(self._runs) > self._max_runs:
+            runs, self._runs = self._runs, []
+            merged = heapq.merge(*[
+                itertools.chain([entry], run) for entry, _, run in runs
+            ])
+            self._add_run(SpillRun(merged, self._spill_dir))
+
+
+    def _add_run(self, run):
+        """Push the first entry of `run` onto the heap of run heads"""
+        for entry in run:
+            heapq.heappush(self._runs, (entry, id(run), run))
+            break
+
+
+    def _pop(self):
+        """Pop the least costly entry from either the in-memory heap or the
+        heads of the spilled runs"""
+        if self._runs and (not self._queue or self._runs[0][0] < self._queue[0]):
+            entry, _, run = heapq.heappop(self._runs)
+            self._add_run(run)
+            return entry
+        return heapq.heappop(self._queue)
+
+
+    def _roots(self):
+        """Yield the key of the most likely preterminal of each base
+        structure in the heap's partition"""
+        first, step = self.partition or (0, 1)
+        for idx in xrange(first, len(self._base_structs), step):
+            bs = self._base_structs[idx]
+            nt_idxs = (0,) * len(bs.terms)
+            yield bs.calc_cost(nt_idxs), idx, nt_idxs
+
+
+    def _children(self, bs_idx, nt_idxs):
+        """Yield the keys of the children of a preterminal.
+
+        Each preterminal has exactly one parent, the one obtained by
+        decrementing its last non-zero index, so a child is only produced by
+        incrementing an index at or after the parent's last non-zero index.
+        The parent is never less probable than the child, so every
+        preterminal is queued before it is needed, and without duplicates.
+        """
+        bs = self._base_structs[bs_idx]
+        for i in range(pivot(nt_idxs), len(bs.terms)):
+            if nt_idxs[i] + 1 < len(bs.terms[i]):
+                new_nt_idxs = nt_idxs[:i] + (nt_idxs[i] + 1,) + nt_idxs[i+1:]
+                yield bs.calc_cost(new_nt_idxs), bs_idx, new_nt_idxs
+
+
+    def seek(self, key):
+        """Position the heap so that it carries on after the preterminal with
+        `key`, as saved from `last_key`.
+
+        Keys increase from parent to child, so the preterminals after `key`
+        are exactly those below the frontier of the preterminals reached from
+        one at or before `key`. The frontier is found by a depth-first walk
+        over the preterminals already generated, which is much cheaper than
+        generating them again.
+        """
+        self._queue, self._runs = [], []
+        self._seeded, self.last_key = True, key
+        if key is None:
+            for entry in self._roots():
+                self._push(entry)
+            return self
+
+        stack = list(self._roots())
+        while stack:
+            entry = stack.pop()
+            if entry > key:
+                self._push(entry)
+            else:
+                stack.extend(self._children(*entry[1:]))
+        return self
+
 
-    
     def __iter__(self):
-        for idx, bs in enumerate(self._base_structs):
-            nt_idxs = [0 for nt in bs[0] if "L" not in nt]
-            heapq.heappush(self._queue, (
-                (1 - self.calc_pt_prob(idx, nt_idxs)), 
-                idx, nt_idxs
-            ))
-        
+        if not self._seeded:
+            self.seek(None)
         return self
 
-    
-    def next(self):
-        """Pull the next preterminal from the heap, inserting new preterminals
-        which are the next most likely forms of that preterminal"""
+
+    def _advance(self):
+        """Pop the key of the next preterminal, inserting the keys of its
+        children"""
+        if not self._seeded:
+            self.seek(None)
         try:
-            prob, bs_idx, nt_idxs = heapq.heappop(self._queue)
+            entry = self._pop()
         except IndexError:
             raise StopIteration()
 
-        l = [nt for nt in self._base_structs[bs_idx][0] if "L" not in nt]
-        for i, nt in enumerate(l):
-            if nt_idxs[i] + 1 < len(self._prob_grammar[nt]):
-                new_nt_idxs = list(nt_idxs)
-                new_nt_idxs[i] += 1
-                new_prob = 1 - self.calc_pt_prob(bs_idx, new_nt_idxs)
+        self.last_key = entry
+        for child in self._children(entry[1], entry[2]):
+            self._push(child)
+        return entry
+
+
+    def next(self):
+        """Pull the next preterminal from the heap, inserting new preterminals
+        which are the next most likely forms of that preterminal"""
+        cost, bs_idx, nt_idxs = self._advance()
+        bs = self._base_structs[bs_idx]
+        return PreTerminal(bs.segments(nt_idxs), -cost)
+
+
+def _generate(heap, partition, key, conn, batch):
+    """Send the preterminals of `partition` after `key` over `conn`, in
+    batches of `batch` entries of their key and segments, followed by an
+    empty batch"""
+    heap.partition = partition
+    heap.seek(key)
+    structs, entries = heap._base_structs, []
+    try:
+        while True:
+            try:
+                entry = heap._advance()
+            except StopIteration:
+                break
+            entries.append(entry + (structs[entry[1]].segments(entry[2]),))
+            if len(entries) >= batch:
+                conn.send_bytes(marshal.dumps(entries))
+                entries = []
+        if entries:
+            conn.send_bytes(marshal.dumps(entries))
+        conn.send_bytes(marshal.dumps([]))
+    except (EOFError, IOError):
+        pass
+
+
+class ParallelPreTerminalHeap(object):
+    """Generates the stream of a PreTerminalHeap with `processes` processes,
+    by default one per core.
+
+    The grammar is read once, and the processes are forked from the head
+    when the first preterminal is pulled, or on `seek`. Each expands its
+    partition of the base structures and sends the keys and segments of its
+    preterminals to the head in batches of `batch`, and the head merges the
+    streams in order of their keys. A process runs at most a batch or so
+    ahead of the head, and the other arguments, such as `max_queue`, are
+    passed to each process' PreTerminalHeap.
+
+    Like a PreTerminalHeap, it has a `last_key` and can `seek` to one, which
+    starts the processes afresh. `close` stops them.
+    """
+    def __init__(self, base_structs, prob_grammar, processes=None,
+            batch=1000, **kwargs):
+        self.processes = processes or multiprocessing.cpu_count()
+        self.batch = batch
+        self.last_key = None
+        self._heap = PreTerminalHeap(base_structs, prob_grammar, **kwargs)
+        self._procs = []
+        self._conns = []
+        self._merged = None
 
-                if (new_prob, bs_idx, new_nt_idxs) not in self._queue:
-                    heapq.heappush(self._queue, (new_prob, bs_idx, new_nt_idxs))
 
-        return self.build_preterminal(bs_idx, nt_idxs)
+    @classmethod
+    def from_profile(cls, profile, **kwargs):
+        """Build a ParallelPreTerminalHeap from the probabilities of a
+        Profile"""
+        return cls(profile.base_structs(), profile.grammar(), **kwargs)
+
+
+    def seek(self, key):
+        """Start the processes over, carrying on after the preterminal with
+        `key`"""
+        self.close()
+        self.last_key = key
+        for i in range(self.processes):
+            reader, writer = multiprocessing.Pipe(False)
+            proc = multiprocessing.Process(target=_generate,
+                args=(self._heap, (i, self.processes), key, writer, self.batch)
+            )
+            proc.daemon = True
+            proc.start()
+            writer.close()
+            self._procs.append(proc)
+            self._conns.append(reader)
+
+        self._merged = heapq.merge(*[
+            itertools.chain.from_iterable(
+                iter(lambda conn=conn: marshal.loads(conn.recv_bytes()), [])
+            )
+            for conn in self._conns
+        ])
+        return self
+
+
+    def close(self):
+        """Stop the processes"""
+        for conn in self._conns:
+            conn.close()
+        for proc in self._procs:
+            proc.terminate()
+            proc.join()
+        self._procs, self._conns, self._merged = [], [], None
+
+
+    def __iter__(self):
+        if self._merged is None:
+            self.seek(self.last_key)
+        return self
+
+
+    def next(self):
+        """Pull the next preterminal from the merged streams"""
+        if self._merged is None:
+            self.seek(self.last_key)
+        cost, bs_idx, nt_idxs, segments = next(self._merged)
+        self.last_key = (cost, bs_idx, nt_idxs)
+        return PreTerminal(segments, -cost)
 
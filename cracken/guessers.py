@@ -5,23 +5,51 @@
     This module provides several guesser iterators which, given an appropriate 
     input, will generate a number of password guesses based on their input.
 """
+from __future__ import absolute_import
+
+from .generator import PreTerminal, pivot
+from .mapped    import MappedGlossary, is_compiled
+
 import collections
-import re
+import heapq
+import itertools
+import math
 
 class PreTerminalGuesser(object):
     """Iterable which generates passwords by combining a preterminal with words
-    from a dictionary.
+    from a dictionary. The preterminal may be a PreTerminal record, or its
+    string form.
+
+    By default the slots are filled odometer style, in glossary order. If
+    `ordered` is True, fills are generated in order of decreasing probability
+    using the word frequencies recorded in the glossary.
+
+    In odometer order, fill n is the number n written in the mixed radix of
+    the slots' glossary sizes, with the last slot least significant. `rank`
+    and `unrank` convert between the two, so any fill can be computed
+    directly, and `fills` and `blocks` can start anywhere in the sequence. A
+    large preterminal can thus be split into `ranges` of fills to be guessed
+    separately.
     """
     glossary = None
+    glossary_probs = None
+    _costs = {}
     
-    def __init__(self, preterminal):
-        self.slots = [
-            term for term in preterminal.split("|")
-            if re.search(r"L\d+", term)
-        ]
-        self.idxs = [0 for term in self.slots]
-        self.lens = [int(term[1:]) for term in self.slots]
-        self.fmtstr = re.sub(r"\|L\d+\|", "{}", preterminal)
+    def __init__(self, preterminal, ordered=False):
+        self.ordered = ordered
+        if not isinstance(preterminal, PreTerminal):
+            preterminal = PreTerminal.parse(preterminal)
+        self.lens = preterminal.lens
+        self.idxs = [0 for l in self.lens]
+        self.fmtstr = "".join(
+            "{}" if isinstance(seg, int) 
+            else seg.replace("{", "{{").replace("}", "}}")
+            for seg in preterminal.segments
+        )
+        self.template = "".join(
+            "%s" if isinstance(seg, int) else seg.replace("%", "%%")
+            for seg in preterminal.segments
+        )
     
     
     @classmethod
@@ -30,22 +58,218 @@ class PreTerminalGuesser(object):
         for generating password guesses. The glossary should consist of lines 
         of the form:
         
-            <length> <word>
+            <length> <word> [<probability>]
+
+        or be a glossary compiled by `cracken.mapped`, which is memory-mapped
+        rather than read.
         """
-        cls.glossary = collections.defaultdict(list)
+        cls._costs = {}
+        if is_compiled(fname):
+            cls.glossary = MappedGlossary(fname)
+            cls.glossary_probs = None
+            return
+
         with open(fname) as f:
-            for line in f:
-                cnt, word = line.split()
-                cls.glossary[int(cnt)].append(word)
+            cls._load_rows(line.split() for line in f)
+
+
+    @classmethod
+    def load_profile(cls, profile):
+        """Class method which loads the glossary from a Profile instead of a
+        glossary file"""
+        cls._costs = {}
+        cls._load_rows(profile.glossary())
+
+
+    @classmethod
+    def _load_rows(cls, rows):
+        cls.glossary = collections.defaultdict(list)
+        cls.glossary_probs = collections.defaultdict(list)
+        for row in rows:
+            cls.glossary[int(row[0])].append(row[1])
+            if len(row) > 2:
+                cls.glossary_probs[int(row[0])].append(float(row[2]))
+
+
+    @classmethod
+    def slot_costs(cls, length):
+        """Return the negative log-probability of each glossary word of
+        `length`. Words are equally likely if the glossary has no
+        probabilities."""
+        if length not in cls._costs:
+            words = cls.glossary[length]
+            if cls.glossary_probs is not None:
+                probs = cls.glossary_probs.get(length)
+            else:
+                probs = words.probs() if words else None
+
+            if probs:
+                cls._costs[length] = [-math.log(p) for p in probs]
+            elif words:
+                cls._costs[length] = [math.log(len(words))] * len(words)
+            else:
+                cls._costs[length] = []
+        return cls._costs[length]
+
+
+    def _ordered_idxs(self):
+        """Yield the glossary indices for each fill in order of decreasing
+        probability, expanding them with the same heap as PreTerminalHeap"""
+        costs = [self.slot_costs(l) for l in self.lens]
+        if not all(costs):
+            return
+
+        idxs = (0,) * len(costs)
+        queue = [(sum(c[0] for c in costs), idxs)]
+        while queue:
+            cost, idxs = heapq.heappop(queue)
+            yield idxs
+            for i in range(pivot(idxs), len(idxs)):
+                if idxs[i] + 1 < len(costs[i]):
+                    new_idxs = idxs[:i] + (idxs[i] + 1,) + idxs[i+1:]
+                    new_cost = sum(c[j] for c, j in zip(costs, new_idxs))
+                    heapq.heappush(queue, (new_cost, new_idxs))
 
     
+    def size(self):
+        """Return the number of fills of the preterminal"""
+        size = 1
+        for l in self.lens:
+            size *= len(self.glossary[l])
+        return size
+
+
+    def unrank(self, n):
+        """Return the glossary indices of fill `n` in odometer order"""
+        if not 0 <= n < self.size():
+            raise IndexError("fill out of range")
+        idxs = []
+        for l in reversed(self.lens):
+            n, idx = divmod(n, len(self.glossary[l]))
+            idxs.append(idx)
+        return tuple(reversed(idxs))
+
+
+    def rank(self, idxs):
+        """Return the position in odometer order of the fill with glossary
+        indices `idxs`"""
+        n = 0
+        for l, idx in zip(self.lens, idxs):
+            n = n * len(self.glossary[l]) + idx
+        return n
+
+
+    def fill(self, n):
+        """Return guess number `n` in odometer order"""
+        return self.template % tuple(
+            self.glossary[l][i] for l, i in zip(self.lens, self.unrank(n))
+        )
+
+
+    def ranges(self, max_size):
+        """Split the fills into `(start, stop)` ranges of odometer order of
+        as even a size as possible, none larger than `max_size`"""
+        size = self.size()
+        parts = max(1, -(-size // max_size))
+        for i in range(parts):
+            yield size * i // parts, size * (i + 1) // parts
+
+
+    def _odometer(self, pools, start):
+        """Yield the fills in odometer order from fill `start` on. The fills
+        after `start` are those which keep the indices of the first i slots,
+        advance the next, and take every word in the slots after that, for
+        each i from the last slot back to the first."""
+        idxs = self.unrank(start)
+        for i in reversed(range(len(pools))):
+            first = idxs[i] + (1 if i < len(pools) - 1 else 0)
+            for fill in itertools.product(*(
+                    [(pool[idx],) for pool, idx in zip(pools[:i], idxs[:i])]
+                    + [pools[i][first:]] + pools[i+1:])):
+                yield fill
+
+
+    def _indexed(self, pools, start):
+        """Yield the fills in odometer order from fill `start` on, looking up
+        each word in its pool by index. The buckets of a compiled glossary are
+        read this way, as itertools.product would copy every word of them."""
+        idxs = list(self.unrank(start))
+        words = [pool[i] for pool, i in zip(pools[:-1], idxs)]
+        last = pools[-1]
+        while True:
+            head = tuple(words)
+            for i in xrange(idxs[-1], len(last)):
+                yield head + (last[i],)
+            idxs[-1] = 0
+            for i in reversed(range(len(pools) - 1)):
+                idxs[i] += 1
+                if idxs[i] < len(pools[i]):
+                    words[i] = pools[i][idxs[i]]
+                    break
+                idxs[i] = 0
+                words[i] = pools[i][0]
+            else:
+                return
+
+
+    def fills(self, start=0, stop=None):
+        """Return an iterator over the tuples of words filling the slots, in
+        the same order as iterating the guesser, from fill `start` up to but
+        not including fill `stop`. In odometer order the iterator starts at
+        `start` directly, while in probability order the fills before it are
+        skipped."""
+        pools = [self.glossary[l] for l in self.lens]
+        if self.ordered:
+            fills = (
+                tuple([pool[i] for pool, i in zip(pools, idxs)])
+                for idxs in self._ordered_idxs()
+            )
+        elif not all(isinstance(pool, (list, tuple)) for pool in pools):
+            if start >= self.size():
+                return iter(())
+            fills = self._indexed(pools, start)
+            stop, start = (None if stop is None else stop - start), 0
+        elif start and start < self.size():
+            fills = self._odometer(pools, start)
+            stop, start = (None if stop is None else stop - start), 0
+        elif start:
+            return iter(())
+        else:
+            fills = itertools.product(*pools)
+
+        if start or stop is not None:
+            return itertools.islice(fills, start, stop)
+        return fills
+
+
+    def blocks(self, size=4096, start=0, stop=None):
+        """Yield the guesses from fill `start` up to fill `stop` in lists of
+        up to `size` guesses, so later stages can work on whole blocks at
+        once"""
+        fills = self.fills(start, stop)
+        fill = self.template.__mod__
+        while True:
+            block = map(fill, itertools.islice(fills, size))
+            if not block:
+                return
+            yield block
+
+
     def __iter__(self):
-        self.idxs = [0 for term in self.slots]
+        self.idxs = [0 for l in self.lens]
         self.exhausted = False
+        if self.ordered:
+            self._order = self._ordered_idxs()
         return self
 
     
     def next(self):
+        if self.ordered:
+            self.idxs = self._order.next()
+            return self.fmtstr.format(
+                *[self.glossary[l][i] for l, i in zip(self.lens, self.idxs)]
+            )
+
         if self.exhausted:
             raise StopIteration()
 
@@ -73,7 +297,8 @@ class ManglingGuesser(object):
     
     Iterating over a ManglingGuesser instance will enumerate all combinations
     of the mangling rules registered to the class with `add_rule`. Rules are
-    applied in the order they were registered.
+    applied in the order they were registered, and each distinct guess is
+    only produced once.
     """
     rules = []
 
@@ -88,25 +313,49 @@ class ManglingGuesser(object):
         """
         cls.rules.append(rule)
 
+
+    @classmethod
+    def mangle(cls, word):
+        """Return the distinct guesses made by applying each combination of
+        the rules to `word`.
+
+        The combinations form a tree with one level per rule, where each node
+        either skips or applies that level's rule. The tree is walked a level
+        at a time, so each rule is applied once per node and shared prefixes
+        are never recomputed. A node which repeats a word already seen at its
+        level, such as a rule which didn't change the word, would only repeat
+        guesses made by an earlier node, so its branch is pruned. Guesses come
+        out in the order the combinations would first produce them, counting
+        with the first rule as the most significant bit.
+        """
+        words = [word]
+        for rule in cls.rules:
+            level, seen = [], set()
+            for word in words:
+                if word not in seen:
+                    seen.add(word)
+                    level.append(word)
+                mangled = rule(word)
+                if mangled not in seen:
+                    seen.add(mangled)
+                    level.append(mangled)
+            words = level
+        return words
+
+
+    @classmethod
+    def mangle_block(cls, words):
+        """Return the guesses made by mangling each word in `words`"""
+        block = []
+        for word in words:
+            block.extend(cls.mangle(word))
+        return block
+
     
     def __iter__(self):
-        self.val = 0
-        self.lim = 2 ** len(self.rules)
+        self._guesses = iter(self.mangle(self.word))
         return self
 
     
     def next(self):
-        if self.val == self.lim:
-            raise StopIteration()
-        
-        # Rule combinations are enumerated by treating a counter as a bit mask 
-        # then applying that mask to the ruleset to filter which rules should 
-        # be applied this round.
-        guess = self.word
-        bit_str = bin(self.val)[2:].rjust(len(self.rules), '0')
-        for rule, bit in zip(self.rules, bit_str):
-            if bit == "1":
-                guess = rule(guess)
-
-        self.val += 1
-        return guess
+        return self._guesses.next()
@@ -0,0 +1,189 @@
+"""
+    cracken.hashing
+    ~~~~~~~~~~~~~~~
+
+    This module implements the HashTarget class, which checks blocks of
+    password guesses against a known hash, and the HashSet class, which checks
+    them against a large list of hashes at once, along with the registry of
+    hash schemes they support.
+
+    A target is hashed as `prefix + guess + suffix`, so salted variants of a
+    scheme are expressed with the prefix and suffix. The hash state after the
+    prefix is computed once and copied for each guess, and digests are
+    compared raw rather than as hex strings.
+"""
+import binascii
+import hashlib
+import hmac
+
+SCHEMES = {}
+
+def register_scheme(name, factory):
+    """Register a hash scheme under `name`. `factory` is called with the
+    target's key, which is None for unkeyed schemes, and should return a fresh
+    hash object supporting `update`, `copy` and `digest`."""
+    SCHEMES[name] = factory
+
+
+def _raw(algorithm):
+    return lambda key: hashlib.new(algorithm)
+
+
+def _hmac(algorithm):
+    return lambda key: hmac.new(key, digestmod=getattr(hashlib, algorithm))
+
+
+for _algorithm in ("md5", "sha1", "sha224", "sha256", "sha384", "sha512"):
+    register_scheme(_algorithm, _raw(_algorithm))
+    register_scheme("hmac-" + _algorithm, _hmac(_algorithm))
+
+
+class Hasher(object):
+    """Hashes guesses under a registered scheme.
+
+    `scheme` names a registered hash scheme. Guesses are hashed as
+    `prefix + guess + suffix`, and `key` is passed to keyed schemes such as
+    HMAC.
+    """
+    def __init__(self, scheme, prefix="", suffix="", key=None):
+        self.scheme = scheme
+        self.prefix = prefix
+        self.suffix = suffix
+        self._state = SCHEMES[scheme](key)
+        self._state.update(prefix)
+
+
+    def decode(self, digest):
+        """Return `digest` as a raw digest, decoding it if it is hex"""
+        if len(digest) == 2 * self._state.digest_size:
+            return binascii.unhexlify(digest)
+        return digest
+
+
+    def hash(self, guess):
+        """Return the raw digest of `guess` under this scheme"""
+        h = self._state.copy()
+        h.update(guess)
+        if self.suffix:
+            h.update(self.suffix)
+        return h.digest()
+
+
+    def digests(self, guesses):
+        """Yield the raw digest of each guess in `guesses`"""
+        copy, suffix = self._state.copy, self.suffix
+        for guess in guesses:
+            h = copy()
+            h.update(guess)
+            if suffix:
+                h.update(suffix)
+            yield h.digest()
+
+
+class HashTarget(Hasher):
+    """A hash to be cracked.
+
+    `digest` is the hash to find, either raw or hex encoded, and the other
+    arguments are those of Hasher.
+    """
+    def __init__(self, scheme, digest, prefix="", suffix="", key=None):
+        super(HashTarget, self).__init__(scheme, prefix, suffix, key)
+        self.digest = self.decode(digest)
+
+
+    def test(self, guess):
+        """Return True if `guess` matches the target"""
+        return self.hash(guess) == self.digest
+
+
+    def search(self, guesses):
+        """Return the index of the first guess in `guesses` which matches the
+        target, or None if none of them do"""
+        copy, digest, suffix = self._state.copy, self.digest, self.suffix
+        if suffix:
+            for idx, guess in enumerate(guesses):
+                h = copy()
+                h.update(guess)
+                h.update(suffix)
+                if h.digest() == digest:
+                    return idx
+        else:
+            for idx, guess in enumerate(guesses):
+                h = copy()
+                h.update(guess)
+                if h.digest() == digest:
+                    return idx
+        return None
+
+
+    def crack(self, blocks):
+        """Search each block of guesses in `blocks` in turn, and return a
+        result with the number of attempts made, and the solution if one was
+        found"""
+        rval = {"attempts": 0}
+        for block in blocks:
+            idx = self.search(block)
+            if idx is not None:
+                rval["attempts"] += idx + 1
+                rval["solution"] = block[idx]
+                break
+            rval["attempts"] += len(block)
+        return rval
+
+
+class HashSet(Hasher):
+    """A set of hashes to be cracked together.
+
+    Every guess is checked against all of the remaining hashes with a single
+    lookup of its raw digest. Hashes are discarded as they are cracked, either
+    locally or when another worker reports them.
+    """
+    def __init__(self, scheme, digests, prefix="", suffix="", key=None):
+        super(HashSet, self).__init__(scheme, prefix, suffix, key)
+        self.remaining = set(self.decode(digest) for digest in digests)
+
+
+    @classmethod
+    def load(cls, scheme, fname, **kwargs):
+        """Load a HashSet from a file of hashes, one hex digest per line"""
+        with open(fname) as f:
+            return cls(scheme, [line.strip() for line in f if line.strip()],
+                **kwargs)
+
+
+    def __len__(self):
+        return len(self.remaining)
+
+
+    def discard(self, digest):
+        """Stop looking for `digest`"""
+        self.remaining.discard(self.decode(digest))
+
+
+    def search(self, guesses):
+        """Return a list of `(index, digest)` for each guess in `guesses`
+        which matches one of the remaining hashes"""
+        remaining = self.remaining
+        return [
+            (idx, digest)
+            for idx, digest in enumerate(self.digests(guesses))
+            if digest in remaining
+        ]
+
+
+    def crack(self, blocks, found=None):
+        """Search each block of guesses in `blocks` until they are exhausted or
+        every hash is cracked. Each match is discarded and passed to
+        `found(guess, digest)` as soon as it is seen. Returns a result with
+        the number of attempts made."""
+        rval = {"attempts": 0}
+        for block in blocks:
+            for idx, digest in self.search(block):
+                if digest in self.remaining:
+                    self.remaining.discard(digest)
+                    if found is not None:
+                        found(block[idx], digest)
+            rval["attempts"] += len(block)
+            if not self.remaining:
+                break
+        return rval
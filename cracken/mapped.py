@@ -0,0 +1,246 @@
+"""
+    cracken.mapped
+    ~~~~~~~~~~~~~~
+
+    This module implements a compiled binary form of the glossary and the
+    probabilistic grammar which workers can memory-map read-only. Opening a
+    compiled file only reads its directory, and every process on a host which
+    maps the same file shares its pages through the page cache.
+
+    A compiled file is a table of buckets, keyed by word length for the
+    glossary and by non-terminal for the grammar. Each bucket holds an offset
+    table and the concatenated strings, along with an array of probabilities
+    for the grammar and for glossaries which record word frequencies. The text
+    formats remain the import path:
+
+        python cracken/mapped.py glossary glossary.txt glossary.bin
+        python cracken/mapped.py grammar prob_grammar.txt prob_grammar.bin
+"""
+import mmap
+import struct
+
+MAGIC = "CRKTBL1\0"
+
+# Directory entry following each key: the number of strings in the bucket,
+# and the file offsets of its offset table, string data and probabilities,
+# the last of which is 0 for a bucket without probabilities
+_ENTRY = struct.Struct("<IQQQ")
+_COUNT = struct.Struct("<I")
+_KEYLEN = struct.Struct("<H")
+_OFFSETS = struct.Struct("<QQ")
+
+
+def is_compiled(fname):
+    """Return True if `fname` is a compiled table rather than a text file"""
+    with open(fname, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def write_table(fname, buckets):
+    """Write a compiled table to `fname`. `buckets` is a list of
+    `(key, strings, probs)` tuples, where `probs` is either None or a list of
+    floats parallel to `strings`."""
+    header = len(MAGIC) + _COUNT.size + sum(
+        _KEYLEN.size + len(str(key)) + _ENTRY.size for key, _, _ in buckets
+    )
+
+    # Lay out the offset table, data and probabilities of each bucket
+    pos, entries = header, []
+    for key, strings, probs in buckets:
+        offsets_pos = pos
+        pos += 8 * (len(strings) + 1)
+        data_pos = pos
+        pos += sum(len(s) for s in strings)
+        probs_pos = 0
+        if probs is not None:
+            probs_pos = pos
+            pos += 8 * len(probs)
+        entries.append((len(strings), offsets_pos, data_pos, probs_pos))
+
+    with open(fname, "wb") as f:
+        f.write(MAGIC)
+        f.write(_COUNT.pack(len(buckets)))
+        for (key, _, _), entry in zip(buckets, entries):
+            key = str(key)
+            f.write(_KEYLEN.pack(len(key)))
+            f.write(key)
+            f.write(_ENTRY.pack(*entry))
+
+        for key, strings, probs in buckets:
+            offset, offsets = 0, [0]
+            for s in strings:
+                offset += len(s)
+                offsets.append(offset)
+            f.write(struct.pack("<{}Q".format(len(offsets)), *offsets))
+            f.write("".join(strings))
+            if probs is not None:
+                f.write(struct.pack("<{}d".format(len(probs)), *probs))
+
+
+class MappedBucket(object):
+    """Read-only sequence of the strings in one bucket of a MappedTable"""
+    def __init__(self, mm, count, offsets_pos, data_pos, probs_pos):
+        self._mm = mm
+        self._count = count
+        self._offsets_pos = offsets_pos
+        self._data_pos = data_pos
+        self._probs_pos = probs_pos
+
+
+    def __len__(self):
+        return self._count
+
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += self._count
+        if not 0 <= idx < self._count:
+            raise IndexError("bucket index out of range")
+        start, stop = _OFFSETS.unpack_from(self._mm, self._offsets_pos + 8*idx)
+        return self._mm[self._data_pos + start:self._data_pos + stop]
+
+
+    def __iter__(self):
+        for idx in range(self._count):
+            yield self[idx]
+
+
+    def prob(self, idx):
+        """Return the probability of the string at `idx`, or None if the
+        bucket has no probabilities"""
+        if not self._probs_pos:
+            return None
+        if not 0 <= idx < self._count:
+            raise IndexError("bucket index out of range")
+        return struct.unpack_from("<d", self._mm, self._probs_pos + 8*idx)[0]
+
+
+    def probs(self):
+        """Return a list of the probabilities of the bucket's strings, or None
+        if the bucket has no probabilities"""
+        if not self._probs_pos:
+            return None
+        return list(struct.unpack_from(
+            "<{}d".format(self._count), self._mm, self._probs_pos
+        ))
+
+
+class MappedTable(object):
+    """A compiled table, memory-mapped read-only. Indexing the table by key
+    returns a MappedBucket, or an empty tuple for a missing key."""
+    def __init__(self, fname):
+        with open(fname, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mm[:len(MAGIC)] != MAGIC:
+            raise ValueError("{} is not a compiled table".format(fname))
+
+        self._buckets = {}
+        self._keys = []
+        pos = len(MAGIC)
+        count, = _COUNT.unpack_from(self._mm, pos)
+        pos += _COUNT.size
+        for i in range(count):
+            keylen, = _KEYLEN.unpack_from(self._mm, pos)
+            pos += _KEYLEN.size
+            key = self._convert_key(self._mm[pos:pos + keylen])
+            pos += keylen
+            entry = _ENTRY.unpack_from(self._mm, pos)
+            pos += _ENTRY.size
+            self._buckets[key] = MappedBucket(self._mm, *entry)
+            self._keys.append(key)
+
+
+    def _convert_key(self, key):
+        return key
+
+
+    def __getitem__(self, key):
+        return self._buckets.get(key, ())
+
+
+    def __contains__(self, key):
+        return key in self._buckets
+
+
+    def __iter__(self):
+        return iter(self._keys)
+
+
+    def keys(self):
+        return list(self._keys)
+
+
+    def items(self):
+        return [(key, self._buckets[key]) for key in self._keys]
+
+
+class MappedGlossary(MappedTable):
+    """A compiled glossary, whose buckets are keyed by word length"""
+    def _convert_key(self, key):
+        return int(key)
+
+
+    def rows(self):
+        """Yield `(length, word)`, or `(length, word, prob)` if the glossary
+        records probabilities, for each word, like a glossary file"""
+        for length, bucket in self.items():
+            probs = bucket.probs()
+            for idx, word in enumerate(bucket):
+                if probs is None:
+                    yield length, word
+                else:
+                    yield length, word, probs[idx]
+
+
+class MappedGrammar(MappedTable):
+    """A compiled grammar, whose buckets are keyed by non-terminal"""
+    def rows(self):
+        """Yield `(nterm, term, prob)` for each terminal, like a grammar file"""
+        for nterm, bucket in self.items():
+            for idx, term in enumerate(bucket):
+                yield nterm, term, bucket.prob(idx)
+
+
+def _group_rows(fname, nfields):
+    """Group the rows of a text glossary or grammar file by their first field,
+    keeping the order in which the keys and rows appear"""
+    groups, keys = {}, []
+    with open(fname) as f:
+        for line in f:
+            fields = line.split()
+            if fields[0] not in groups:
+                groups[fields[0]] = []
+                keys.append(fields[0])
+            groups[fields[0]].append(fields[1:nfields])
+    return [(key, groups[key]) for key in keys]
+
+
+def compile_glossary(txtfile, binfile):
+    """Compile the text glossary `txtfile` into `binfile`, keeping the word
+    probabilities if the glossary has them"""
+    write_table(binfile, [
+        (int(length), [row[0] for row in rows],
+            [float(row[1]) for row in rows] if len(rows[0]) > 1 else None)
+        for length, rows in _group_rows(txtfile, 3)
+    ])
+
+
+def compile_grammar(txtfile, binfile):
+    """Compile the text grammar `txtfile` into `binfile`"""
+    write_table(binfile, [
+        (nterm, [row[0] for row in rows], [float(row[1]) for row in rows])
+        for nterm, rows in _group_rows(txtfile, 3)
+    ])
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("kind", choices=["glossary", "grammar"])
+    parser.add_argument("txtfile")
+    parser.add_argument("binfile")
+    args = parser.parse_args()
+    if args.kind == "glossary":
+        compile_glossary(args.txtfile, args.binfile)
+    else:
+        compile_grammar(args.txtfile, args.binfile)
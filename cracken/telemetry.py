@@ -0,0 +1,163 @@
+"""
+    cracken.telemetry
+    ~~~~~~~~~~~~~~~~~
+
+    This module implements the worker side of the Bullpen's telemetry, a set
+    of counters which each worker process adds to and periodically reports to
+    the head, and the Telemetry class, which aggregates the reports and
+    exports snapshots of them as JSON lines or Prometheus text.
+
+    Counters are cumulative, so that rates can be computed from any two
+    reports, and by convention counters of time end in "_seconds". Every
+    worker counts its "tasks", the "task_seconds" spent running them, and the
+    "idle_seconds" spent waiting for them. Worker functions add their own,
+    such as "guesses", with `add` and `timed`.
+"""
+from collections    import defaultdict
+
+import json
+import os
+import re
+import time
+
+_counters = defaultdict(float)
+
+def add(name, value=1):
+    """Add `value` to this worker's counter `name`"""
+    _counters[name] += value
+
+
+def total(name):
+    """Return the current value of this worker's counter `name`"""
+    return _counters.get(name, 0)
+
+
+def timed(name, iterable):
+    """Yield the items of `iterable`, adding the time spent producing them to
+    the counter `name`"""
+    iterator = iter(iterable)
+    while True:
+        start = time.time()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            _counters[name] += time.time() - start
+            return
+        _counters[name] += time.time() - start
+        yield item
+
+
+def reset():
+    """Zero this worker's counters"""
+    _counters.clear()
+
+
+def report(worker):
+    """Return a report of this worker's counters, to be sent to the head"""
+    return {"worker": worker, "time": time.time(), "counters": dict(_counters)}
+
+
+class Telemetry(object):
+    """Aggregates the reports of a Bullpen's workers.
+
+    The latest two reports of each worker are kept, and a worker's rates, in
+    units per second, are computed from the difference between them. A
+    snapshot also gives the totals of every counter and rate across the
+    workers, and the derived "mean_task_seconds".
+    """
+    def __init__(self):
+        self._reports = {}
+
+
+    def update(self, report):
+        """Record a worker's report"""
+        last = self._reports.get(report["worker"], (None, None))[1]
+        self._reports[report["worker"]] = (last, report)
+
+
+    def snapshot(self, **gauges):
+        """Return a snapshot of the workers' counters and rates. Any `gauges`,
+        such as the depth of the task queue, are included as given."""
+        workers, totals, rates = {}, defaultdict(float), defaultdict(float)
+        now = time.time()
+        for worker, (last, current) in self._reports.items():
+            counters = current["counters"]
+            worker_rates = {}
+            if last and current["time"] > last["time"]:
+                interval = current["time"] - last["time"]
+                for name, value in counters.items():
+                    worker_rates[name] = (
+                        value - last["counters"].get(name, 0)) / interval
+
+            workers[worker] = {
+                "age": now - current["time"],
+                "counters": counters,
+                "rates": worker_rates,
+            }
+            for name, value in counters.items():
+                totals[name] += value
+            for name, value in worker_rates.items():
+                rates[name] += value
+
+        if totals["tasks"]:
+            totals["mean_task_seconds"] = totals["task_seconds"] / totals["tasks"]
+        return {
+            "time": now,
+            "gauges": gauges,
+            "totals": dict(totals),
+            "rates": dict(rates),
+            "workers": workers,
+        }
+
+
+def to_json(snapshot):
+    """Format `snapshot` as a single JSON line"""
+    return json.dumps(snapshot, sort_keys=True) + "\n"
+
+
+def _metric_name(name):
+    return "cracken_" + re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+
+def to_prometheus(snapshot):
+    """Format `snapshot` in the Prometheus text exposition format. Counters
+    are labelled by worker, and rates and gauges are exported as gauges."""
+    lines = []
+    names = sorted(set(
+        name
+        for worker in snapshot["workers"].values()
+        for name in worker["counters"]
+    ))
+    for name in names:
+        metric = _metric_name(name) + "_total"
+        lines.append("# TYPE {} counter".format(metric))
+        for worker, stats in sorted(snapshot["workers"].items()):
+            if name in stats["counters"]:
+                lines.append('{}{{worker="{}"}} {!r}'.format(
+                    metric, worker, stats["counters"][name]
+                ))
+
+    for name, value in sorted(snapshot["rates"].items()):
+        metric = _metric_name(name) + "_per_second"
+        lines.append("# TYPE {} gauge".format(metric))
+        lines.append("{} {!r}".format(metric, value))
+
+    for name, value in sorted(snapshot["gauges"].items()):
+        metric = _metric_name(name)
+        lines.append("# TYPE {} gauge".format(metric))
+        lines.append("{} {!r}".format(metric, value))
+    return "\n".join(lines) + "\n"
+
+
+def export(snapshot, fname, format="json"):
+    """Write `snapshot` to the file named `fname`. JSON lines are appended to
+    the file, while Prometheus text replaces it atomically, as expected by a
+    textfile collector."""
+    if format == "json":
+        with open(fname, "a") as f:
+            f.write(to_json(snapshot))
+        return
+
+    with open(fname + ".tmp", "w") as f:
+        f.write(to_prometheus(snapshot))
+    os.rename(fname + ".tmp", fname)
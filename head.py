@@ -1,19 +1,55 @@
-from cracken.generator      import PreTerminalHeap
+from cracken.generator      import ParallelPreTerminalHeap, PreTerminalHeap
+from cracken.guessers       import PreTerminalGuesser
 from cracken.bullpen        import Bullpen
+from cracken.hashing        import HashSet
+from cracken.telemetry      import export
 
+import argparse
 import datetime
+import itertools
+import os
 import signal
 import sys
 import threading
+import time
 
 stats = {}
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--audit", action="store_true",
+        help="crack every hash listed in targets.txt instead of the challenge")
+    parser.add_argument("--checkpoint", default="cracken.ckpt",
+        help="file to which the session's progress is saved every minute")
+    parser.add_argument("--resume", action="store_true",
+        help="carry on from the checkpoint of an earlier session")
+    parser.add_argument("--split", type=int, default=1000000,
+        help="preterminals with more fills than this are split into tasks "
+            "of at most this many fills")
+    parser.add_argument("--metrics",
+        help="file to which the workers' telemetry is exported every 10s")
+    parser.add_argument("--metrics-format", default="json",
+        choices=["json", "prometheus"],
+        help="export JSON lines, or Prometheus text for a textfile collector")
+    parser.add_argument("--daemons", action="store_true",
+        help="run on the worker daemons connected to this host instead of "
+            "launching workers over ssh; BULLPEN_AUTHKEY must be set")
+    parser.add_argument("--generators", type=int, default=1,
+        help="processes generating the preterminals, each expanding a share "
+            "of the base structures; 0 for one per core")
+    args = parser.parse_args()
+    if args.daemons and not os.getenv("BULLPEN_AUTHKEY"):
+        parser.error("--daemons needs the daemons' authkey in BULLPEN_AUTHKEY")
+    if args.audit and not os.path.exists("targets.txt"):
+        parser.error("--audit needs the hashes to crack in targets.txt")
+
     # Stat collection
     stats["start"] = datetime.datetime.now()
     stats["solution"] = stats["restime"] = stats["start"]
     stats["queued"] = stats["exhausted"] = stats["start"]
     stats["attempts"] = stats["preterms"] = stats["hosts"] = 0
+    stats["tasks"] = 0
+    stats["cracked"] = 0
     stats["result"] = "N/A"
     
     def print_stats():
@@ -21,19 +57,49 @@ if __name__ == "__main__":
         sys.stdout.write(
             "\nCracken Report:\n" +
             "  Result:          {}\n".format(stats["result"]) +
+            "  Cracked:         {}\n".format(stats["cracked"]) +
             "  Runtime:         {}\n".format(ended - stats["start"]) +
             "  Discovery Time:  {}\n".format(stats["restime"] - stats["start"]) +
             "  Time to Queue:   {}\n".format(stats["queued"] - stats["start"]) +
             "  Exhaustion Time: {}\n".format(stats["exhausted"] - stats["start"]) +
             "  Attempts:        {}\n".format(stats["attempts"]) +
             "  Preterminals:    {}\n".format(stats["preterms"]) +
+            "  Tasks:           {}\n".format(stats["tasks"]) +
             "  Hosts:           {}\n".format(stats["hosts"])
         )
 
     # Set up the Bullpen
-    hosts = ["tesla{}".format(i) for i in range(1,31)] * 4
+    hosts = ["tesla{}".format(i) for i in range(1,31)]
     stats["hosts"] = len(hosts)
-    bp = Bullpen(hosts, "worker.cracker")
+    # At most 10000 preterminals are queued at once, so they are generated as
+    # the workers need them, and the preterminals of a host which stops
+    # responding for 5 minutes are handed out again. The cluster is cancelled
+    # as soon as a worker finds the solution, or when auditing, once every
+    # hash in targets.txt has been cracked, which also stops the enqueuing.
+    # Worker daemons keep worker.py loaded until it or one of the files it
+    # loads changes.
+    resources = ["glossary.txt", "targets.txt"]
+    if args.audit:
+        # A hash may be reported by more than one worker before the others
+        # hear it was cracked, so distinct hashes are counted
+        targets = len(HashSet.load("sha256", "targets.txt"))
+        cracked = set()
+
+        def all_cracked(result):
+            if "cracked" not in result:
+                return False
+            cracked.add(result["cracked"])
+            return len(cracked) == targets
+
+        bp = Bullpen(hosts, "worker.auditor", processes=4, prefetch=4,
+            max_queued=10000, lease=300, daemons=args.daemons,
+            resources=resources, stop_on=all_cracked
+        )
+    else:
+        bp = Bullpen(hosts, "worker.cracker", processes=4, prefetch=4,
+            max_queued=10000, lease=300, daemons=args.daemons,
+            resources=resources, stop_on=lambda result: "solution" in result
+        )
     bp.launch_workers()
     
     # Set up the signal handler to print a report when Ctrl-c is recieved
@@ -43,33 +109,112 @@ if __name__ == "__main__":
         
     signal.signal(signal.SIGINT, sigint_handler)
 
-    # Set up the result gathering thread
-    def get_result(bullpen):
+    # Results and worker status events are handled as they arrive
+    def on_result(result):
+        if "cracked" in result:
+            stats["restime"] = datetime.datetime.now()
+            stats["cracked"] += 1
+            sys.stdout.write("CRACKED: {} {}\n".format(
+                result["cracked"], result["solution"]
+            ))
+        elif "solution" in result:
+            stats["restime"] = datetime.datetime.now()
+            stats["result"] = result["solution"]
+            sys.stdout.write("MATCH: {}\n".format(result["solution"]))
+        if "attempts" in result:
+            stats["attempts"] += result["attempts"]
+            stats["tasks"] += 1
+
+    def on_status(event):
+        if event["event"] == "lost":
+            sys.stdout.write("{} workers lost.\n".format(event["workers"]))
+        elif event["event"] == "launched":
+            sys.stdout.write("{}: {} workers launched.\n".format(
+                event["host"], event["workers"]
+            ))
+        elif event["event"] == "failed":
+            sys.stdout.write("{}: launch failed.\n{}".format(
+                event["host"], event["error"]
+            ))
+        else:
+            sys.stdout.write("{}: worker {}.\n".format(
+                event["worker"], event["event"]
+            ))
+
+    bp.on_result(on_result)
+    bp.on_status(on_status)
+
+    # Export the workers' telemetry, along with the depth of the task queue
+    def export_metrics(bullpen):
         while True:
-            result = bullpen.get_result()
-            if "solution" in result:
-                stats["restime"] = datetime.datetime.now()
-                stats["result"] = result["solution"]
-                sys.stdout.write("MATCH: {}\n".format(result["solution"]))
-            if "attempts" in result:
-                stats["attempts"] += result["attempts"]
-                stats["preterms"] += 1
-
-    t = threading.Thread(target=get_result, args=(bp,))
-    t.daemon = True
-    t.start()
+            time.sleep(10)
+            export(bullpen.metrics(), args.metrics, args.metrics_format)
+
+    if args.metrics:
+        m = threading.Thread(target=export_metrics, args=(bp,))
+        m.daemon = True
+        m.start()
     
-    # Enqueue the preterminals
-    preterms_generated = 0
-    for preterm in PreTerminalHeap("base_structs.txt", "prob_grammar.txt"):
-        preterms_generated += 1
-        bp.enqueue(preterm)
-        
+    # Enqueue the preterminals, splitting those with more than `--split` fills
+    # into evenly sized ranges of fills so that no single task holds up the
+    # end of the run. The glossary is loaded to count the fills. With several
+    # generators, the head only merges their streams, in the same order.
+    PreTerminalGuesser.load_glossary("glossary.txt")
+    if args.generators == 1:
+        heap = PreTerminalHeap("base_structs.txt", "prob_grammar.txt",
+            max_queue=1000000
+        )
+    else:
+        heap = ParallelPreTerminalHeap("base_structs.txt", "prob_grammar.txt",
+            processes=args.generators or None, max_queue=1000000
+        )
+    split = {"preterm": None, "done": 0}
+
+    def tasks():
+        while True:
+            if split["preterm"]:
+                ranges = PreTerminalGuesser(split["preterm"]).ranges(args.split)
+                for start, stop in itertools.islice(ranges, split["done"], None):
+                    split["done"] += 1
+                    yield split["preterm"], start, stop
+                split["preterm"] = None
+
+            preterm = str(next(heap))
+            stats["preterms"] += 1
+            if PreTerminalGuesser(preterm).size() <= args.split:
+                yield (preterm,)
+            else:
+                split.update(preterm=preterm, done=0)
+
+    # The progress is the last preterminal taken from the heap, along with
+    # the preterminal being split and how many of its ranges were enqueued.
+    # When resuming, the tasks left unfinished by the earlier session are
+    # requeued first.
+    def progress():
+        return {"key": heap.last_key, "split": dict(split)}
+
+    if args.resume:
+        state = bp.restore(args.checkpoint)
+        heap.seek(state["key"])
+        split.update(state["split"])
+
+    def checkpoint(bullpen):
+        while True:
+            time.sleep(60)
+            bullpen.checkpoint(args.checkpoint, progress)
+
+    c = threading.Thread(target=checkpoint, args=(bp,))
+    c.daemon = True
+    c.start()
+
+    tasks_queued = bp.enqueue_many(tasks())
+
     bp.kill_workers()
     stats["queued"] = datetime.datetime.now()
-    sys.stdout.write("All {} Tasks Queued.\n".format(preterms_generated))
+    sys.stdout.write("All {} Tasks Queued.\n".format(tasks_queued))
     
     # Wait for all the workers to report termination
     bp.join()
+    bp.checkpoint(args.checkpoint, progress)
     stats["exhausted"] = datetime.datetime.now()
     print_stats()
@@ -0,0 +1,7 @@
+"""
+    tests
+    ~~~~~
+
+    Regression tests of cracken's exact-order guarantees, over small fixed
+    grammars and glossaries. Run them with `python -m unittest discover`.
+"""
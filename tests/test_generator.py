@@ -0,0 +1,201 @@
+"""
+    tests.test_generator
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Tests of the order in which the PreTerminalHeap generates preterminals.
+"""
+from __future__ import absolute_import
+
+from cracken.generator  import ParallelPreTerminalHeap, PreTerminalHeap
+
+import heapq
+import itertools
+import shutil
+import tempfile
+import unittest
+
+STRUCTS = [("D1|S1", 0.5), ("S1|D2", 0.3), ("L2|D1", 0.2)]
+GRAMMAR = [
+    ("D1", "1", 0.5), ("D1", "2", 0.3), ("D1", "3", 0.2),
+    ("S1", "!", 0.7), ("S1", "?", 0.3),
+    ("D2", "12", 0.6), ("D2", "99", 0.4),
+]
+
+# A grammar with several hundred preterminals, many of them tied. Terminals
+# are listed most likely first, as the classifier writes them.
+WIDE_STRUCTS = [("D1|S1|D1", 0.4), ("S1|D2", 0.3), ("D2|L3", 0.2), ("L4", 0.1)]
+WIDE_GRAMMAR = (
+    [("D1", str(i), 0.1) for i in range(10)]
+    + [("S1", s, p) for s, p in zip("!?#$", (0.4, 0.3, 0.2, 0.1))]
+    + [("D2", "{:02}".format(i), (20 - i) / 210.0) for i in range(20)]
+)
+
+# The preterminals of STRUCTS and GRAMMAR, in order of decreasing probability
+EXPECTED = [
+    "1!", "!12", "2!", "|L2|1", "!99", "1?", "3!", "|L2|2", "?12", "2?",
+    "|L2|3", "?99", "3?",
+]
+
+
+def baseline(structs, grammar):
+    """Return the stream of the original PreTerminalHeap, which scanned its
+    queue for duplicates and ordered preterminals by the probability of their
+    terminals alone"""
+    prob_grammar = {}
+    for nterm, term, prob in grammar:
+        prob_grammar.setdefault(nterm, []).append((term, prob))
+    structs = [struct.split("|") for struct, _ in structs]
+
+    def prob(bs_idx, nt_idxs):
+        prod = 1
+        nts = [nt for nt in structs[bs_idx] if "L" not in nt]
+        for nt, idx in zip(nts, nt_idxs):
+            prod *= prob_grammar[nt][idx][1]
+        return prod
+
+    def build(bs_idx, nt_idxs):
+        res, cur_nt_idx = "", 0
+        for nt in structs[bs_idx]:
+            if "L" in nt:
+                res += "|{}|".format(nt)
+            else:
+                res += prob_grammar[nt][nt_idxs[cur_nt_idx]][0]
+                cur_nt_idx += 1
+        return res
+
+    queue, stream = [], []
+    for idx, bs in enumerate(structs):
+        nt_idxs = [0 for nt in bs if "L" not in nt]
+        heapq.heappush(queue, (1 - prob(idx, nt_idxs), idx, nt_idxs))
+    while queue:
+        _, bs_idx, nt_idxs = heapq.heappop(queue)
+        nts = [nt for nt in structs[bs_idx] if "L" not in nt]
+        for i, nt in enumerate(nts):
+            if nt_idxs[i] + 1 < len(prob_grammar[nt]):
+                new_nt_idxs = list(nt_idxs)
+                new_nt_idxs[i] += 1
+                entry = (1 - prob(bs_idx, new_nt_idxs), bs_idx, new_nt_idxs)
+                if entry not in queue:
+                    heapq.heappush(queue, entry)
+        stream.append(build(bs_idx, nt_idxs))
+    return stream
+
+
+def stream(heap):
+    return [str(pt) for pt in heap]
+
+
+class PreTerminalHeapOrderTest(unittest.TestCase):
+    def test_expected_order(self):
+        heap = PreTerminalHeap(STRUCTS, GRAMMAR)
+        self.assertEqual(stream(heap), EXPECTED)
+
+
+    def test_probabilities_decrease(self):
+        probs = [pt.prob for pt in PreTerminalHeap(STRUCTS, GRAMMAR)]
+        self.assertEqual(probs, sorted(probs, reverse=True))
+        self.assertAlmostEqual(probs[0], 0.5 * 0.5 * 0.7)
+
+
+    def test_matches_baseline(self):
+        # The original heap ignored the base structures' probabilities, so
+        # they are made equal for the comparison
+        structs = [(struct, 1.0 / 3) for struct, _ in STRUCTS]
+        self.assertEqual(
+            stream(PreTerminalHeap(structs, GRAMMAR)),
+            baseline(structs, GRAMMAR)
+        )
+
+
+    def test_every_preterminal_once(self):
+        grammar = [("D1", str(i), 0.1) for i in range(10)] + [
+            ("S1", s, 0.25) for s in "!?#$"
+        ]
+        structs = [("D1|S1|D1", 0.6), ("S1|D1", 0.4)]
+        pts = stream(PreTerminalHeap(structs, grammar))
+        self.assertEqual(len(pts), 10 * 4 * 10 + 4 * 10)
+        self.assertEqual(len(set(pts)), len(pts))
+
+
+class SpillTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+
+    def test_spilling_keeps_order(self):
+        expected = stream(PreTerminalHeap(WIDE_STRUCTS, WIDE_GRAMMAR))
+        for max_queue, max_runs in ((2, 64), (4, 2), (16, 1), (100, 4)):
+            heap = PreTerminalHeap(WIDE_STRUCTS, WIDE_GRAMMAR,
+                max_queue=max_queue, max_runs=max_runs, spill_dir=self.dir)
+            self.assertEqual(stream(heap), expected)
+
+
+class SeekTest(unittest.TestCase):
+    def test_seek_carries_on(self):
+        heap = PreTerminalHeap(WIDE_STRUCTS, WIDE_GRAMMAR)
+        keys, expected = [None], []
+        for pt in heap:
+            keys.append(heap.last_key)
+            expected.append(str(pt))
+        self.assertEqual(keys[1:], sorted(set(keys[1:])))
+
+        for i, key in enumerate(keys):
+            resumed = PreTerminalHeap(WIDE_STRUCTS, WIDE_GRAMMAR).seek(key)
+            self.assertEqual(stream(resumed), expected[i:])
+
+
+    def test_seek_with_spilling(self):
+        heap = PreTerminalHeap(WIDE_STRUCTS, WIDE_GRAMMAR)
+        expected = stream(heap)
+        heap = PreTerminalHeap(WIDE_STRUCTS, WIDE_GRAMMAR)
+        list(itertools.islice(heap, 100))
+        resumed = PreTerminalHeap(WIDE_STRUCTS, WIDE_GRAMMAR, max_queue=4)
+        self.assertEqual(stream(resumed.seek(heap.last_key)), expected[100:])
+
+
+class ParallelTest(unittest.TestCase):
+    def test_partitions_cover_the_stream(self):
+        expected = stream(PreTerminalHeap(WIDE_STRUCTS, WIDE_GRAMMAR))
+        partitions = [
+            list(PreTerminalHeap(WIDE_STRUCTS, WIDE_GRAMMAR, partition=(i, 3)))
+            for i in range(3)
+        ]
+        self.assertEqual(sorted(map(str, sum(partitions, []))),
+            sorted(expected))
+
+
+    def test_same_order_as_one_heap(self):
+        expected = list(PreTerminalHeap(WIDE_STRUCTS, WIDE_GRAMMAR))
+        for processes in (1, 2, 3, 5):
+            heap = ParallelPreTerminalHeap(WIDE_STRUCTS, WIDE_GRAMMAR,
+                processes=processes, batch=7)
+            try:
+                self.assertEqual(list(heap), expected)
+            finally:
+                heap.close()
+
+
+    def test_seek(self):
+        heap = PreTerminalHeap(WIDE_STRUCTS, WIDE_GRAMMAR)
+        expected, last_key = stream(heap), heap.last_key
+        heap = PreTerminalHeap(WIDE_STRUCTS, WIDE_GRAMMAR)
+        list(itertools.islice(heap, 150))
+
+        parallel = ParallelPreTerminalHeap(WIDE_STRUCTS, WIDE_GRAMMAR,
+            processes=3, batch=10)
+        try:
+            self.assertEqual(stream(itertools.islice(parallel, 50)),
+                expected[:50])
+            parallel.seek(heap.last_key)
+            self.assertEqual(stream(parallel), expected[150:])
+            self.assertEqual(parallel.last_key, last_key)
+        finally:
+            parallel.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
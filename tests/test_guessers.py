@@ -0,0 +1,188 @@
+"""
+    tests.test_guessers
+    ~~~~~~~~~~~~~~~~~~~
+
+    Tests of the order in which the guessers generate guesses.
+"""
+from __future__ import absolute_import
+
+from cracken.guessers   import ManglingGuesser, PreTerminalGuesser
+from cracken.mapped     import compile_glossary
+
+import itertools
+import os
+import shutil
+import tempfile
+import unittest
+
+# Words of each length, most likely first
+WORDS = {
+    1: [("a", 0.5), ("b", 0.3), ("c", 0.2)],
+    2: [("xy", 0.4), ("zz", 0.3), ("qq", 0.2), ("pp", 0.1)],
+    3: [("cat", 0.6), ("dog", 0.4)],
+}
+
+PRETERMINALS = [
+    "|L1|", "|L2|!", "|L1||L2|", "1|L3|2|L1|", "|L2||L1||L3|", "123", "|L5|",
+]
+
+
+class GlossaryTestCase(unittest.TestCase):
+    """Writes the glossary of WORDS to a temporary file, and loads it"""
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.mkdtemp()
+        cls.glossary = os.path.join(cls.dir, "glossary.txt")
+        with open(cls.glossary, "w") as f:
+            for length, words in sorted(WORDS.items()):
+                for word, prob in words:
+                    f.write("{} {} {}\n".format(length, word, prob))
+
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.dir)
+
+
+    def setUp(self):
+        PreTerminalGuesser.load_glossary(self.glossary)
+
+
+class RankTest(GlossaryTestCase):
+    def test_fills_are_the_odometer(self):
+        guesser = PreTerminalGuesser("|L1||L2|")
+        self.assertEqual(list(guesser.fills()), [
+            (w1, w2) for w1, _ in WORDS[1] for w2, _ in WORDS[2]
+        ])
+        self.assertEqual(list(guesser.blocks(5))[0],
+            ["axy", "azz", "aqq", "app", "bxy"])
+
+
+    def test_rank_and_unrank(self):
+        for pt in PRETERMINALS:
+            guesser = PreTerminalGuesser(pt)
+            fills = list(guesser.fills())
+            self.assertEqual(len(fills), guesser.size())
+            for n, fill in enumerate(fills):
+                idxs = guesser.unrank(n)
+                self.assertEqual(guesser.rank(idxs), n)
+                self.assertEqual(guesser.fill(n),
+                    guesser.template % fill)
+            self.assertRaises(IndexError, guesser.unrank, len(fills) or 1)
+
+
+    def test_fills_from_any_start(self):
+        for pt in PRETERMINALS:
+            guesser = PreTerminalGuesser(pt)
+            fills = list(guesser.fills())
+            for start in range(len(fills) + 2):
+                for stop in (None, start, start + 1, start + 5):
+                    self.assertEqual(list(guesser.fills(start, stop)),
+                        fills[start:stop])
+
+
+    def test_ranges_split_the_fills(self):
+        for pt in PRETERMINALS:
+            guesser = PreTerminalGuesser(pt)
+            guesses = list(itertools.chain(*guesser.blocks()))
+            for max_size in (1, 2, 3, 7, 100):
+                ranges = list(guesser.ranges(max_size))
+                sizes = [stop - start for start, stop in ranges]
+                self.assertEqual(ranges[0][0], 0)
+                self.assertEqual(ranges[-1][1], guesser.size())
+                self.assertTrue(all(
+                    a[1] == b[0] for a, b in zip(ranges, ranges[1:])
+                ))
+                self.assertTrue(max(sizes) <= max_size)
+                self.assertTrue(max(sizes) - min(sizes) <= 1)
+                self.assertEqual(list(itertools.chain(*[
+                    itertools.chain(*guesser.blocks(3, start, stop))
+                    for start, stop in ranges
+                ])), guesses)
+
+
+    def test_ordered_fills_decrease_in_probability(self):
+        guesser = PreTerminalGuesser("|L2||L1||L3|", ordered=True)
+        probs = {word: prob for words in WORDS.values()
+            for word, prob in words}
+        fills = list(guesser.fills())
+        self.assertEqual(sorted(fills), sorted(
+            PreTerminalGuesser("|L2||L1||L3|").fills()
+        ))
+        scores = [probs[a] * probs[b] * probs[c] for a, b, c in fills]
+        for high, low in zip(scores, scores[1:]):
+            self.assertTrue(high >= low - 1e-12)
+
+
+class CompiledGlossaryTest(GlossaryTestCase):
+    def test_same_fills_as_text(self):
+        compiled = os.path.join(self.dir, "glossary.bin")
+        compile_glossary(self.glossary, compiled)
+        for pt in PRETERMINALS:
+            runs = []
+            for fname in (self.glossary, compiled):
+                PreTerminalGuesser.load_glossary(fname)
+                guesser = PreTerminalGuesser(pt)
+                size = guesser.size()
+                runs.append([
+                    list(guesser.fills(start, stop))
+                    for start in range(size + 2)
+                    for stop in (None, start + 1, start + 4, size)
+                ] + [
+                    list(guesser.blocks(3, 1)),
+                    list(PreTerminalGuesser(pt, ordered=True).fills()),
+                ])
+            self.assertEqual(runs[0], runs[1])
+
+
+class ManglingTest(unittest.TestCase):
+    # Rules which often leave a word unchanged, or undo one another
+    RULES = [
+        lambda s: s.replace("a", "4"),
+        lambda s: s.replace("4", "a"),
+        lambda s: s.replace("o", "0"),
+        lambda s: s.capitalize(),
+        lambda s: s + "!",
+        lambda s: s.rstrip("!"),
+    ]
+
+    def setUp(self):
+        self.rules = ManglingGuesser.rules
+        ManglingGuesser.rules = list(self.RULES)
+
+
+    def tearDown(self):
+        ManglingGuesser.rules = self.rules
+
+
+    def combinations(self, word):
+        """Return the distinct results of applying each combination of the
+        rules to `word`, counting with the first rule as the most
+        significant bit"""
+        rules, guesses = ManglingGuesser.rules, []
+        for mask in range(2 ** len(rules)):
+            guess = word
+            for i, rule in enumerate(rules):
+                if mask >> (len(rules) - 1 - i) & 1:
+                    guess = rule(guess)
+            if guess not in guesses:
+                guesses.append(guess)
+        return guesses
+
+
+    def test_mangle_matches_every_combination(self):
+        for word in ("password", "a4a4", "foo!", "", "Zoo", "4"):
+            self.assertEqual(ManglingGuesser.mangle(word),
+                self.combinations(word))
+            self.assertEqual(list(ManglingGuesser(word)),
+                self.combinations(word))
+
+
+    def test_mangle_block(self):
+        words = ["password", "a4a4", "password"]
+        self.assertEqual(ManglingGuesser.mangle_block(words),
+            sum([self.combinations(word) for word in words], []))
+
+
+if __name__ == "__main__":
+    unittest.main()
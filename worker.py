@@ -1,16 +1,29 @@
 import base64
 import binascii
-import hashlib
-import re
+import itertools
+import os
+import time
 
+from cracken          import bullpen, telemetry
+from cracken.dedup    import BloomFilter
 from cracken.guessers import PreTerminalGuesser, ManglingGuesser
+from cracken.hashing  import HashSet, HashTarget
 
 # Taken from packet captures
 challenge = "1092789947"
-hash1 = binascii.hexlify(
-    base64.b64decode("/AJj/qta3G2RHNdje8AfPeIkIgFct4u03+ceN9jQA4Q=")
+target = HashTarget("sha256",
+    base64.b64decode("/AJj/qta3G2RHNdje8AfPeIkIgFct4u03+ceN9jQA4Q="),
+    prefix="TheLimpDiskettes:" + challenge + ":",
 )
-guessfmtstr = "TheLimpDiskettes:" + challenge + ":{}"
+
+# Unsalted SHA-256 hashes to audit, one hex digest per line. Hashes cracked
+# by any worker are broadcast so every other worker stops looking for them.
+targets = None
+if os.path.exists("targets.txt"):
+    targets = HashSet.load("sha256", "targets.txt")
+    bullpen.on_notice(
+        lambda notice: notice[0] == "cracked" and targets.discard(notice[1])
+    )
 
 # Load the glossary for the PreTerminalGuesser
 PreTerminalGuesser.load_glossary("glossary.txt")
@@ -23,18 +36,93 @@ ManglingGuesser.add_rule(lambda s: s.replace("o", "0"))
 ManglingGuesser.add_rule(lambda s: s + "!")  
 ManglingGuesser.add_rule(lambda s: s + "?")  
 
+# Set to the expected number of distinct guesses per job on a host to skip
+# guesses which any worker on the host has already made for the same job.
+# Checking a guess against the filter costs more than hashing it with SHA-256,
+# so it is off by default; see cracken.dedup.
+dedup_capacity = None
+seen = None
+
+def new_filter(queue_id):
+    """Start each job with an empty filter, made before its workers are forked
+    so that they all share it"""
+    global seen
+    if seen is not None:
+        seen.close()
+    seen = BloomFilter(dedup_capacity)
+
+if dedup_capacity:
+    bullpen.on_launch(new_filter)
+
+
+# Fills per block. Cancellation is checked between blocks, and mangling makes
+# about ten guesses of each fill, so a cancelled task returns after tens of
+# milliseconds with blocks of 256 fills, rather than hundreds with 4096, at no
+# measurable cost in speed.
+block_size = 256
 
-def cracker(preterminal):
+def live(blocks):
+    """Pass blocks through until the running task is cancelled"""
+    return itertools.takewhile(lambda block: not bullpen.cancelled(), blocks)
+
+
+def mangled(blocks):
+    """Mangle each block of guesses, dropping the guesses already made on this
+    host if the duplicate filter is enabled. A task handed out again after its
+    worker was lost makes every guess, since the lost worker added its
+    guesses to the filter without necessarily hashing them."""
+    dedup = seen is not None and not bullpen.retried()
+    for block in blocks:
+        block = ManglingGuesser.mangle_block(block)
+        if dedup:
+            fresh = seen.filter_block(block)
+            telemetry.add("duplicates", len(block) - len(fresh))
+            block = fresh
+        yield block
+
+
+def metered(crack, blocks, *args):
+    """Run `crack` over `blocks`, counting the guesses made, and splitting the
+    time taken between generating the guesses and hashing them"""
+    generated = telemetry.total("generate_seconds")
+    started = time.time()
+    rval = crack(telemetry.timed("generate_seconds", blocks), *args)
+    telemetry.add("hash_seconds", time.time() - started -
+        (telemetry.total("generate_seconds") - generated))
+    telemetry.add("guesses", rval["attempts"])
+    return rval
+
+
+def guess_blocks(preterminal, start=0, stop=None):
+    """Return the blocks of fills of `preterminal`, in order of decreasing
+    probability, or in odometer order from fill `start` to fill `stop` if the
+    head split the preterminal into ranges"""
+    if start or stop is not None:
+        return PreTerminalGuesser(preterminal).blocks(block_size, start, stop)
+    return PreTerminalGuesser(preterminal, ordered=True).blocks(block_size)
+
+
+def cracker(preterminal, start=0, stop=None):
     """Given a preterminal, iterate filling it, and then apply mangling rules
-    to generate a set of password guesses.
+    to generate a set of password guesses. Only the fills from `start` to
+    `stop` are tried if they are given. Stops early if the task is cancelled.
     """
-    rval = {"attempts": 0}
-    for terminal in PreTerminalGuesser(preterminal):
-        for permutation in ManglingGuesser(terminal):
-            test = hashlib.sha256(guessfmtstr.format(permutation)).hexdigest()
-            rval["attempts"] += 1
-            
-            if hash1 == test:
-                rval["solution"] = permutation
-                return rval
-    return rval
+    return metered(target.crack,
+        mangled(live(guess_blocks(preterminal, start, stop)))
+    )
+
+
+def auditor(preterminal, start=0, stop=None):
+    """Given a preterminal, generate password guesses as `cracker` does, and
+    check them against every remaining hash in `targets`. Cracked hashes are
+    sent to the head as they are found, and the task carries on.
+    """
+    def found(guess, digest):
+        bullpen.post(("cracked", digest))
+        bullpen.emit({"cracked": binascii.hexlify(digest), "solution": guess})
+
+    if targets is None:
+        raise IOError("No targets.txt to audit in {}".format(os.getcwd()))
+    return metered(targets.crack,
+        mangled(live(guess_blocks(preterminal, start, stop))), found
+    )